@@ -0,0 +1,146 @@
+#! /usr/bin/python3
+'''
+Moves an assembled program to new .text and .data base addresses by patching
+the words listed in its relocation file (mipster -R) in its text hex image
+'''
+
+import argparse
+import array
+import mmap
+import sys
+
+import mipster
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+hex_record = 9 # bytes per word of a mipster hex image: 8 digits and a newline
+
+# relocation field -> (bits that change, how far the segment base is shifted)
+reloc_fields = {'j26': (0x3ffffff, 2), 'hi16': (0xffff, 16), 'lo16': (0, 0)}
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('image', help='text segment hex file from mipster')
+	parser.add_argument('relocs', help='relocation file from mipster -R')
+	parser.add_argument('-t', '--text', metavar='ADDR', type=lambda x: int(x, 0),
+						help='new .text base address')
+	parser.add_argument('-d', '--data', metavar='ADDR', type=lambda x: int(x, 0),
+						help='new .data base address')
+	args = parser.parse_args()
+
+	try:
+		patched = rebase(args.image, args.relocs, args.text, args.data)
+	except (mipster.ASMError, IOError) as ex:
+		print(ex)
+		return 1
+	print('Patched %d words' % patched)
+	return 0
+
+def rebase(image, relocs, text=None, data=None):
+	'''
+	patches a text hex image in place for new segment base addresses, and
+	records them in the relocation file so that it can be rebased again;
+	both files are mmapped and only the relocated words are touched
+	args:
+		image = text segment hex file from mipster, one 32-bit word per line
+		relocs = relocation file written by mipster -R
+		text, data = new base addresses, or None to keep the current one
+	returns:
+		number of words patched
+	'''
+	with open(relocs, 'r+b') as rf:
+		rmap = mmap.mmap(rf.fileno(), 0)
+		try:
+			magic, old_text, old_data, n = mipster.reloc_header.unpack_from(rmap)
+			if magic != mipster.reloc_magic:
+				raise mipster.ASMError('%s is not a mipster relocation file' % relocs)
+			start = mipster.reloc_header.size
+			words = array.array('I', rmap[start:start + 4*n])
+			if sys.byteorder == 'big':
+				words.byteswap()
+			text = old_text if text is None else text
+			data = old_data if data is None else data
+			bases = {'text': (old_text, text), 'data': (old_data, data)}
+			patched = 0
+			if words:
+				with open(image, 'r+b') as f:
+					patched = patch_image(f, words, bases)
+			rmap[:start] = mipster.reloc_header.pack(magic, text, data, n)
+		finally:
+			rmap.close()
+	return patched
+
+def patch_image(f, words, bases):
+	'''
+	applies relocations to a mipster hex image
+	args:
+		f = image file, opened for reading and writing in binary mode
+		words = array of relocations, see mipster.get_relocations()
+		bases = segment name -> (old base address, new base address)
+	returns:
+		number of words patched
+	'''
+	kinds = {}
+	if numpy is not None:
+		w = numpy.frombuffer(words, numpy.uint32)
+		for kind in numpy.unique(w & 7):
+			kinds[int(kind)] = w[w & 7 == kind] >> 3
+	else:
+		for w in words:
+			kinds.setdefault(w & 7, array.array('I')).append(w >> 3)
+	mm = mmap.mmap(f.fileno(), 0)
+	try:
+		if len(mm) % hex_record or mm[8:9] != b'\n':
+			raise mipster.ASMError('%s is not a 32-bit hex image' % f.name)
+		count = len(mm) // hex_record
+		patched = 0
+		for kind, indices in sorted(kinds.items()):
+			seg, field = mipster.reloc_kinds[kind].split()
+			old, new = bases[seg]
+			mask, shift = reloc_fields[field]
+			delta = new - old
+			align = 4 if field == 'j26' else 0x10000 # %lo() parts must not change
+			if delta % align:
+				raise mipster.ASMError('Cannot move .%s from 0x%08x to 0x%08x: '
+					'%s relocations need a multiple of 0x%x' % (seg, old, new, field, align))
+			if field == 'j26' and (old ^ new) >> 28:
+				raise mipster.ASMError('Cannot move .%s from 0x%08x to 0x%08x: '
+					'jumps stay within a 256 MiB region' % (seg, old, new))
+			if max(indices) >= count:
+				raise mipster.ASMError('Relocation past the end of %s' % f.name)
+			if mask and delta:
+				if numpy is not None:
+					patch_words_numpy(mm, indices, mask, delta >> shift)
+				else:
+					patch_words(mm, indices, mask, delta >> shift)
+				patched += len(indices)
+	finally:
+		mm.close()
+	return patched
+
+def patch_words(mm, indices, mask, add):
+	'''adds add to the bits in mask of each listed word of a mapped hex image'''
+	for k in indices:
+		o = hex_record * k
+		w = int(mm[o:o+8], 16)
+		mm[o:o+8] = b'%08x' % ((w & ~mask) | ((w + add) & mask))
+
+def patch_words_numpy(mm, indices, mask, add):
+	'''patch_words() for all the listed words at once'''
+	rows = numpy.frombuffer(mm, numpy.uint8).reshape(-1, hex_record)
+	idx = numpy.asarray(indices, numpy.intp)
+	digits = rows[idx, :8]
+	# ASCII hex digit -> value, for '0'-'9', 'a'-'f' and 'A'-'F'
+	digits = numpy.where(digits > ord('9'), (digits | 0x20) - (ord('a') - 10),
+						digits - ord('0')).astype(numpy.int64)
+	shifts = numpy.arange(28, -4, -4)
+	w = (digits << shifts).sum(axis=1)
+	w = (w & ~mask) | ((w + add) & mask)
+	rows[idx, :8] = numpy.frombuffer(b'0123456789abcdef', numpy.uint8)[
+		(w[:, None] >> shifts) & 0xf]
+
+if __name__ == '__main__':
+	sys.exit(main())
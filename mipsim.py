@@ -0,0 +1,2935 @@
+#! /usr/bin/python3
+'''
+A functional simulator for MIPS programs assembled by mipster
+'''
+
+import argparse
+import array
+import cmd
+import collections
+import concurrent.futures
+import io
+import math
+import mmap
+import os.path
+import random
+import re
+import struct
+import sys
+import tempfile
+
+import mipster
+
+try:
+	import numpy
+except ImportError: # only needed for lockstep simulation
+	numpy = None
+
+mask32 = 0xffffffff
+data_addr = mipster.data_start_addr << 16 # .data is addressed by its upper half
+stack_addr = 0x7fffeffc # initial $sp, as in MARS
+global_addr = 0x10008000 # initial $gp, as in MARS
+heap_addr = 0x10040000 # first address returned by sbrk, as in MARS
+page_bits = 12 # 4 KiB memory pages
+page_size = 1 << page_bits
+page_mask = page_size - 1
+zero_page = bytes(page_size) # read in place of pages never written
+snapshot_magic = b'MIPSSNP2'
+# magic, text start, text words, pc, hi, lo, halted, exit code, steps, pages,
+# heap break, target of the delay slot being stepped (no_value if none)
+snapshot_header = struct.Struct('<8sIIIIIIiQIII')
+snapshot_regs = struct.Struct('<32I32I8?') # GPRs, FPRs, FP condition codes
+
+trace_magic = b'MIPSTRC1'
+trace_header = struct.Struct('<8sI') # magic, text start address
+trace_fields = 5 # pc, word, destination, value, memory address
+no_value = 0xffffffff # destination or memory address of commands without one
+hi_reg, lo_reg = 64, 65 # destinations past the GPRs (0-31) and FPRs (32-63)
+# syscall number -> register it returns a value in; the others write none
+syscall_dests = {5: 2, 6: 32, 7: 32, 9: 2, 12: 2, 13: 2, 14: 2, 15: 2}
+
+SimResult = collections.namedtuple('SimResult',
+	'index exit_code steps regs output memory error')
+
+# commands whose only effect is writing rd or rt, which become nops for $zero
+rd_dest_cmds = ('add','addu','sub','subu','and','or','xor','nor','slt','sltu',
+	'sll','srl','sra','sllv','srlv','srav','rotr','rotrv','mfhi','mflo','mul',
+	'movn','movz','seb','seh','wsbh')
+rt_dest_cmds = ('addiu','andi','ori','xori','slti','sltiu','lui','ext','ins',
+	'lb','lbu','lh','lhu','lw','mfc1')
+
+single = struct.Struct('<f')
+double = struct.Struct('<d')
+word = struct.Struct('<I')
+half = struct.Struct('<H')
+dword = struct.Struct('<Q')
+
+class SimError(Exception):
+	def __init__(self, value):
+		self.value = value
+	def __str__(self):
+		return str(self.value)
+
+class WatchHit(Exception):
+	'''raised by memory, before the access, when a watched address is used'''
+	def __init__(self, addr, write):
+		self.addr = addr
+		self.write = write
+	def __str__(self):
+		return 'Watchpoint: %s 0x%08x' % ('write to' if self.write else 'read from',
+										self.addr)
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('txt', help='text segment hex file from mipster (or Intel HEX or raw .bin)')
+	parser.add_argument('-d', '--data', metavar='HEX',
+						help='data segment image (default: matching _dat.hex)')
+	parser.add_argument('--isa', metavar='FILE', default='mips_isa.txt',
+						help='ISA description file (default: %(default)s)')
+	parser.add_argument('-g', '--debug-info', metavar='DBG',
+						help='debug info written by mipster -g, for labels and lines')
+	parser.add_argument('--delay-slots', action='store_true',
+						help='execute the command after each branch or jump')
+	parser.add_argument('-n', '--max-steps', metavar='N', type=int, default=0,
+						help='stop after N commands')
+	parser.add_argument('-i', '--input', metavar='FILE', type=argparse.FileType('rb'),
+						help='file read by input syscalls (default: standard input)')
+	parser.add_argument('-O', '--output', metavar='FILE', type=argparse.FileType('wb'),
+						help='file written by output syscalls (default: standard output)')
+	parser.add_argument('--batch', metavar='INPUT', nargs='+',
+						help='run once per INPUT file, given as its input, in parallel, '
+						'writing each run\'s output to INPUT.out')
+	parser.add_argument('-j', '--jobs', metavar='N', type=int, default=0,
+						help='worker processes for --batch (default: one per core)')
+	parser.add_argument('--lockstep', action='store_true',
+						help='run --batch inputs together, one command at a time for '
+						'all of them, using NumPy')
+	parser.add_argument('--restore', metavar='SNAP',
+						help='start from a snapshot of this program saved by --snapshot')
+	parser.add_argument('--snapshot', metavar='SNAP',
+						help='save the machine state when the simulation stops')
+	parser.add_argument('--debugger', action='store_true',
+						help='run under the interactive debugger')
+	parser.add_argument('-r', '--regs', action='store_true',
+						help='print the registers when the program stops')
+	parser.add_argument('--icache', metavar='SIZE:WAYS:LINE[:lru|random]',
+						type=cache_arg, help='model an instruction cache')
+	parser.add_argument('--dcache', metavar='SIZE:WAYS:LINE[:lru|random]',
+						type=cache_arg, help='model a data cache')
+	parser.add_argument('--predictor', choices=['not-taken', 'btfn', 'bimodal', 'gshare'],
+						help='model a branch predictor: static not taken, static '
+						'backward taken/forward not taken, 2-bit counters indexed '
+						'by address, or 2-bit counters indexed by address xor history')
+	parser.add_argument('--predictor-bits', metavar='N', type=int, default=10,
+						help='log2 of the predictor table size (default: %(default)s)')
+	parser.add_argument('--history', metavar='N', type=int, default=8,
+						help='gshare global history length (default: %(default)s)')
+	parser.add_argument('--pipeline', action='store_true',
+						help='time the program on a 5-stage pipeline with forwarding')
+	parser.add_argument('--resolve', choices=['ID', 'EX'], default='ID', type=str.upper,
+						help='pipeline stage that resolves branches (default: %(default)s)')
+	parser.add_argument('--timeline', metavar='LO:HI', type=range_arg,
+						help='print pipeline timelines of commands in an address range')
+	parser.add_argument('--timeline-rows', metavar='N', type=int, default=100,
+						help='most timeline rows to print (default: %(default)s)')
+	parser.add_argument('-t', '--trace', metavar='FILE',
+						help='record every command executed in a binary trace file')
+	parser.add_argument('--trace-last', metavar='N', type=int, default=0,
+						help='only keep the last N commands of the trace')
+	parser.add_argument('-p', '--profile', action='store_true',
+						help='print the most executed labels')
+	parser.add_argument('--collapsed', metavar='FILE',
+						help='write call stacks in collapsed (flame graph) format')
+	parser.add_argument('--annotate', metavar='FILE',
+						help='write a listing annotated with execution counts')
+	args = parser.parse_args()
+
+	if not args.data:
+		args.data = re.sub('_txt\.hex$', '_dat.hex', args.txt)
+		if args.data == args.txt or not os.path.exists(args.data):
+			args.data = None
+	try:
+		isa = mipster.get_mips_isa(args.isa)
+		sim = Simulator(isa, load_hex(args.txt),
+						load_hex(args.data) if args.data else [],
+						delay_slots=args.delay_slots,
+						io=SyscallIO(args.input, args.output))
+		if args.restore:
+			sim.restore(args.restore)
+		if args.batch:
+			return run_batch(sim, args.batch, args.jobs, args.max_steps,
+							args.lockstep)
+	except (mipster.ASMError, SimError, IOError, ValueError) as ex:
+		print(ex)
+		return 1
+	debug = mipster.DebugInfo(args.debug_info) if args.debug_info else None
+	if args.profile or args.collapsed or args.annotate:
+		sim.profiler = Profiler(sim)
+		sim.block_hooks.append(sim.profiler.block)
+	caches = []
+	if args.icache:
+		caches.append(ICache(sim, *args.icache))
+	if args.dcache:
+		caches.append(DCache(sim, *args.dcache))
+	pipeline = None
+	if args.pipeline or args.timeline:
+		pipeline = Pipeline(sim, args.resolve, args.timeline, args.timeline_rows)
+	tracer = None
+	if args.trace:
+		tracer = Tracer(sim, open(args.trace, 'wb'), args.trace_last)
+	predictor = None
+	if args.predictor:
+		predictor = predictors[args.predictor](sim, args.predictor_bits,
+											args.history)
+
+	try:
+		if args.debugger:
+			Debugger(sim, debug).cmdloop()
+		else:
+			sim.run(args.max_steps)
+	except SimError as ex:
+		sys.stdout.flush()
+		print('Error: %s' % ex, file=sys.stderr)
+	sys.stdout.flush()
+	print('%d commands executed' % sim.steps, file=sys.stderr)
+	if tracer:
+		tracer.close()
+	if args.snapshot:
+		sim.save(args.snapshot)
+	if args.regs:
+		print_regs(sim)
+	prof = sim.profiler
+	if args.profile:
+		prof.print_hot_spots(debug)
+	for cache in caches:
+		cache.print_stats(debug)
+	if predictor:
+		predictor.print_stats(debug)
+	if pipeline:
+		pipeline.print_stats()
+		if args.timeline:
+			pipeline.print_timeline()
+	if args.collapsed:
+		with open(args.collapsed, 'w') as f:
+			prof.write_collapsed(f, debug)
+	if args.annotate:
+		with open(args.annotate, 'w') as f:
+			prof.write_annotated(f, debug)
+	if debug:
+		debug.close()
+	return sim.exit_code
+
+def load_hex(filename):
+	'''reads a memory image (hex, Intel HEX or raw, see mipster.read_image())'''
+	return mipster.read_image(filename).tolist()
+
+def run_batch(sim, filenames, jobs, max_steps, lockstep=False):
+	'''runs sim's program on each input file, reporting runs as they finish'''
+	inputs = []
+	for name in filenames:
+		with open(name, 'rb') as f:
+			inputs.append(f.read())
+	failed = 0
+	if lockstep:
+		results = simulate_lanes(sim, inputs, max_steps=max_steps)
+	else:
+		results = simulate_many(sim.isa, sim.text, sim.data, inputs, jobs=jobs,
+								max_steps=max_steps, delay_slots=sim.delay_slots)
+	for r in results:
+		with open(filenames[r.index] + '.out', 'wb') as f:
+			f.write(r.output)
+		print('%s: exit %d, %d commands%s' % (filenames[r.index], r.exit_code,
+			r.steps, ', error: ' + r.error if r.error else ''))
+		failed += bool(r.error or r.exit_code)
+	return 1 if failed else 0
+
+def simulate_many(isa, text, data, inputs, jobs=0, max_steps=0, regions=(),
+				delay_slots=False, chunk=None):
+	'''
+	runs a program once per input on a pool of worker processes; the program
+	is sent to and decoded by each worker once, and inputs are sent in chunks
+	args:
+		isa = the ISA dict
+		text, data = the program's .text and .data words
+		inputs = sequence of inputs, each either the bytes read by input
+			syscalls or a dict with any of 'stdin' (bytes), 'regs'
+			({register name or number: value}) and 'memory' ({address: bytes})
+		jobs = number of worker processes, or 0 for one per core
+		max_steps = commands each run may execute (0 = no limit)
+		regions = (address, length) memory ranges to return from each run
+		chunk = inputs per task (default: enough for ~4 tasks per worker)
+	returns:
+		generator of SimResult, in the order runs finish
+	'''
+	jobs = jobs or os.cpu_count() or 1
+	inputs = list(inputs)
+	chunk = chunk or max(1, min(256, len(inputs) // (4 * jobs)))
+	initargs = (isa, text, data, delay_slots, max_steps, regions)
+	if jobs == 1:
+		init_sim_worker(*initargs)
+		for k in range(0, len(inputs), chunk):
+			for r in run_worker_chunk(k, inputs[k:k+chunk]):
+				yield r
+		return
+	with concurrent.futures.ProcessPoolExecutor(jobs, initializer=init_sim_worker,
+			initargs=initargs) as pool:
+		tasks = [pool.submit(run_worker_chunk, k, inputs[k:k+chunk])
+				for k in range(0, len(inputs), chunk)]
+		for t in concurrent.futures.as_completed(tasks):
+			for r in t.result():
+				yield r
+
+def init_sim_worker(isa, text, data, delay_slots, max_steps, regions):
+	'''decodes the program in a simulate_many() worker process'''
+	global worker_sim, worker_limits
+	worker_sim = Simulator(isa, text, data, delay_slots=delay_slots)
+	for i in range(len(text)):
+		worker_sim.predecode(i)
+	worker_limits = (max_steps, regions)
+
+def run_worker_chunk(start, inputs):
+	'''runs inputs numbered from start in a worker, returning SimResults'''
+	return [run_input(worker_sim, start + k, inp, *worker_limits)
+			for k, inp in enumerate(inputs)]
+
+def run_input(sim, index, inp, max_steps=0, regions=()):
+	'''resets sim, runs it on one simulate_many() input and returns a SimResult'''
+	if not isinstance(inp, dict):
+		inp = {'stdin': inp}
+	out = io.BytesIO()
+	sim.reset(SyscallIO(io.BytesIO(inp.get('stdin', b'')), out))
+	for reg, val in inp.get('regs', {}).items():
+		try:
+			n = reg if isinstance(reg, int) else mipster.reg_num(reg)
+		except mipster.ASMError as ex:
+			raise SimError(str(ex))
+		if n:
+			sim.regs[n] = val & mask32
+	for addr, contents in inp.get('memory', {}).items():
+		sim.mem.store_bytes(addr, contents)
+	error = None
+	try:
+		sim.run(max_steps)
+	except SimError as ex:
+		error = str(ex)
+	return SimResult(index, sim.exit_code, sim.steps, tuple(sim.regs),
+		out.getvalue(), tuple(sim.mem.load_bytes(a, n) for a, n in regions), error)
+
+def simulate_lanes(sim, inputs, max_steps=0, regions=()):
+	'''
+	runs sim's program on many inputs in lockstep, each command executing
+	once for all of them on NumPy vectors; commands and syscalls with no
+	vector version (input, sbrk, files, COP1...) run lane by lane on sim's
+	handlers, and only inputs that take another way than most at a branch
+	or jump are finished one at a time by sim
+	args:
+		sim = Simulator holding the program (it is reset for scalar runs)
+		inputs, max_steps, regions = as for simulate_many()
+	returns:
+		list of SimResult, in input order
+	'''
+	if numpy is None:
+		raise SimError('Lockstep simulation requires NumPy')
+	if sim.delay_slots:
+		raise SimError('Lockstep simulation does not support delay slots')
+	return Lockstep(sim, inputs, max_steps, regions).run()
+
+class Lockstep(object):
+	'''
+	the state of a lockstep run: the registers of all lanes as a 32 x lanes
+	uint32 array (each register's lanes contiguous), a mask of the lanes
+	still in lockstep, memory as the program image shared by all lanes plus
+	a vector of per-lane values for each word written, and a SyscallIO per
+	lane holding its input, output and heap
+	'''
+	def __init__(self, sim, inputs, max_steps=0, regions=()):
+		inputs = [x if isinstance(x, dict) else {'stdin': x} for x in inputs]
+		n = len(inputs)
+		self.sim = sim
+		self.base = PagedMemory() # the program image
+		self.base.store_words(sim.text_start, sim.text)
+		self.base.store_words(data_addr, sim.data)
+		self.max_steps = max_steps
+		self.regions = regions
+		self.lanes = n
+		self.regs = numpy.zeros((32, n), numpy.uint32)
+		self.regs[28] = global_addr
+		self.regs[29] = stack_addr
+		self.hi = numpy.zeros(n, numpy.uint32)
+		self.lo = numpy.zeros(n, numpy.uint32)
+		self.fregs = numpy.zeros((32, n), numpy.uint32)
+		self.fcc = numpy.zeros((8, n), bool)
+		self.words = {} # word address -> uint32 lane vector
+		self.active = numpy.ones(n, bool)
+		self.io = [SyscallIO(io.BytesIO(x.get('stdin', b'')), io.BytesIO())
+				for x in inputs]
+		self.out = [x.out for x in self.io] # output buffers, written in place
+		self.results = [None] * n
+		self.steps = 0
+		self.pc = sim.text_start
+		for k, inp in enumerate(inputs):
+			for reg, val in inp.get('regs', {}).items():
+				try:
+					r = reg if isinstance(reg, int) else mipster.reg_num(reg)
+				except mipster.ASMError as ex:
+					raise SimError(str(ex))
+				if r:
+					self.regs[r, k] = val & mask32
+		self.load_inputs([x.get('memory', {}) for x in inputs])
+
+	def load_inputs(self, memories):
+		'''stores each lane's input memory contents'''
+		keys = set((addr, len(data)) for m in memories for addr, data in m.items())
+		for addr, size in keys:
+			datas = [m.get(addr) for m in memories]
+			if addr & 3 or size & 3 or any(d is None or len(d) != size for d in datas):
+				for k, d in enumerate(datas): # byte at a time
+					if d is not None and len(d) == size:
+						for j, b in enumerate(bytearray(d)):
+							a = addr + j
+							vec = self.vector(a >> 2)
+							shift = 8 * (a & 3)
+							vec[k] = (int(vec[k]) & ~(0xff << shift) | b << shift) & mask32
+				continue
+			# every lane has a word aligned value: copy them a word at a time
+			block = numpy.frombuffer(b''.join(datas), '<u4').reshape(self.lanes, -1)
+			for j in range(size >> 2):
+				self.vector((addr >> 2) + j)[:] = block[:, j]
+
+	def vector(self, a):
+		'''returns the lane vector of word address a, creating it if needed'''
+		vec = self.words.get(a)
+		if vec is None:
+			vec = self.words[a] = numpy.full(self.lanes,
+				self.base.load_word(a << 2), numpy.uint32)
+		return vec
+
+	def put(self, r, v):
+		'''writes v to register r of the active lanes'''
+		if r:
+			numpy.copyto(self.regs[r], v, casting='unsafe', where=self.active)
+
+	def signed(self, r):
+		return self.regs[r].view(numpy.int32)
+
+	def load(self, addrs, align=4):
+		'''returns the words holding byte addresses addrs, for the active lanes'''
+		bad = self.active & (addrs & (align - 1) != 0)
+		if bad.any():
+			self.fail(bad, 'Unaligned load from 0x%08x' % addrs[bad][0])
+		a = addrs >> 2
+		lanes = numpy.unique(a[self.active])
+		if len(lanes) == 1: # the usual case: every lane uses the same address
+			vec = self.words.get(int(lanes[0]))
+			return vec if vec is not None else numpy.uint32(
+				self.base.load_word(int(lanes[0]) << 2))
+		out = numpy.zeros(self.lanes, numpy.uint32)
+		for u in lanes:
+			m = self.active & (a == u)
+			vec = self.words.get(int(u))
+			out[m] = vec[m] if vec is not None else self.base.load_word(int(u) << 2)
+		return out
+
+	def store(self, addrs, vals, width=32):
+		'''stores the low width bits of vals at byte addresses addrs, for the active lanes'''
+		align = width >> 3
+		bad = self.active & (addrs & (align - 1) != 0)
+		if bad.any():
+			self.fail(bad, 'Unaligned store to 0x%08x' % addrs[bad][0])
+		A = self.active
+		if width < 32:
+			shift = (addrs & 3) << 3
+			m = numpy.uint32((1 << width) - 1) << shift
+			vals = (self.load(addrs, align) & ~m) | ((vals << shift) & m)
+		a = addrs >> 2
+		for u in numpy.unique(a[A]):
+			numpy.copyto(self.vector(int(u)), vals, casting='unsafe',
+				where=A & (a == u))
+
+	def address(self, c):
+		'''returns the effective addresses of a load or store'''
+		return self.regs[c[1]] + numpy.uint32(c[6] & mask32)
+
+	def check_overflow(self, v):
+		'''stops the active lanes where v doesn't fit in 32 signed bits'''
+		bad = self.active & ((v < -0x80000000) | (v > 0x7fffffff))
+		if bad.any():
+			self.fail(bad, 'Arithmetic overflow at 0x%08x' % self.pc)
+
+	def put_hilo(self, p):
+		'''writes a 64-bit uint64 product to HI and LO of the active lanes'''
+		numpy.copyto(self.hi, p >> numpy.uint64(32), casting='unsafe', where=self.active)
+		numpy.copyto(self.lo, p & numpy.uint64(mask32), casting='unsafe', where=self.active)
+
+	def fail(self, lanes, error):
+		'''stops lanes with an error in the current command, which isn't counted'''
+		self.finish(lanes, error=error, steps=self.steps - 1)
+
+	def finish(self, lanes, exit_codes=0, error=None, steps=None):
+		'''
+		records the results of lanes that stopped in lockstep, after steps
+		commands (default: all those run so far)
+		'''
+		steps = self.steps if steps is None else steps
+		for k in numpy.flatnonzero(lanes):
+			regs = tuple(int(x) for x in self.regs[:, k])
+			memory = tuple(self.lane_bytes(k, a, n) for a, n in self.regions)
+			code = exit_codes if isinstance(exit_codes, int) else int(exit_codes[k])
+			self.results[k] = SimResult(int(k), code, steps, regs,
+				self.lane_output(k), memory, error)
+		self.active &= ~lanes
+
+	def lane_output(self, k):
+		'''returns everything lane k has written'''
+		return self.io[k].stdout.getvalue() + bytes(self.out[k])
+
+	def lane_bytes(self, k, addr, n):
+		'''reads n bytes of lane k's memory'''
+		out = bytearray()
+		for a in range(addr & ~3, addr + n, 4):
+			vec = self.words.get(a >> 2)
+			w = int(vec[k]) if vec is not None else self.base.load_word(a)
+			out += word.pack(w)
+		return bytes(out[addr & 3:(addr & 3) + n])
+
+	def lane_string(self, k, addr):
+		'''reads a NUL terminated string from lane k's memory'''
+		out = bytearray()
+		while True:
+			chunk = self.lane_bytes(k, addr, 4 - (addr & 3))
+			end = chunk.find(b'\0')
+			if end >= 0:
+				return bytes(out + chunk[:end])
+			out += chunk
+			addr = (addr + len(chunk)) & mask32
+
+	def scalar(self, lanes, pcs, steps):
+		'''finishes lanes one at a time on the scalar simulator, from pcs'''
+		sim = self.sim
+		for k in numpy.flatnonzero(lanes):
+			sim.reset(self.io[k])
+			sim.regs = [int(x) for x in self.regs[:, k]]
+			sim.fregs = [int(x) for x in self.fregs[:, k]]
+			sim.fcc = [bool(x) for x in self.fcc[:, k]]
+			sim.hi, sim.lo = int(self.hi[k]), int(self.lo[k])
+			for a, vec in self.words.items():
+				sim.mem.store_word(a << 2, int(vec[k]))
+			sim.pc = pcs if isinstance(pcs, int) else int(pcs[k])
+			sim.steps = steps
+			error = None
+			try:
+				if not self.max_steps or steps < self.max_steps:
+					sim.run(self.max_steps - steps if self.max_steps else 0)
+			except SimError as ex:
+				error = str(ex)
+			self.results[k] = SimResult(int(k), sim.exit_code, sim.steps,
+				tuple(sim.regs), self.lane_output(k),
+				tuple(sim.mem.load_bytes(a, n) for a, n in self.regions), error)
+		self.active &= ~lanes
+
+	def branch(self, taken, c):
+		'''
+		follows a branch taken by some lanes: the larger group stays in
+		lockstep and the other is finished by the scalar simulator
+		'''
+		A = self.active
+		t = taken & A
+		n_taken = numpy.count_nonzero(t)
+		n = numpy.count_nonzero(A)
+		if n_taken == n:
+			return c[7]
+		if not n_taken:
+			return None
+		if 2 * n_taken >= n:
+			self.scalar(A & ~taken, c[8] + 4, self.steps)
+			return c[7]
+		self.scalar(t, c[7], self.steps)
+		return None
+
+	def jump(self, targets):
+		'''follows a register jump, keeping the lanes with the commonest target'''
+		A = self.active
+		if not A.any():
+			return None
+		vals, counts = numpy.unique(targets[A], return_counts=True)
+		target = int(vals[numpy.argmax(counts)])
+		if len(vals) > 1:
+			self.scalar(A & (targets != target), targets, self.steps)
+		return target
+
+	def each_lane(self, c):
+		'''
+		runs a command with no vector version on each active lane in turn,
+		using sim's handler on the lane's registers, memory and SyscallIO
+		returns:
+			the next pc of the lanes that stay in lockstep (see jump())
+		'''
+		sim = self.sim
+		saved = (sim.regs, sim.fregs, sim.fcc, sim.hi, sim.lo, sim.mem, sim.io,
+				sim.halted, sim.exit_code)
+		targets = numpy.full(self.lanes, c[8] + 4, numpy.int64)
+		halted = numpy.zeros(self.lanes, bool)
+		codes = numpy.zeros(self.lanes, numpy.int64)
+		errors = collections.defaultdict(list)
+		try:
+			for k in numpy.flatnonzero(self.active):
+				sim.regs = [int(x) for x in self.regs[:, k]]
+				sim.fregs = [int(x) for x in self.fregs[:, k]]
+				sim.fcc = [bool(x) for x in self.fcc[:, k]]
+				sim.hi, sim.lo = int(self.hi[k]), int(self.lo[k])
+				sim.mem = LaneMemory(self, k)
+				sim.io = self.io[k]
+				sim.halted = False
+				sim.exit_code = 0
+				try:
+					t = c[0](sim, c)
+				except SimError as ex:
+					errors[str(ex)].append(k)
+					continue
+				self.regs[:, k] = sim.regs
+				self.fregs[:, k] = sim.fregs
+				self.fcc[:, k] = sim.fcc
+				self.hi[k], self.lo[k] = sim.hi, sim.lo
+				if sim.halted:
+					halted[k] = True
+					codes[k] = sim.exit_code
+				elif t is not None:
+					targets[k] = t
+		finally:
+			(sim.regs, sim.fregs, sim.fcc, sim.hi, sim.lo, sim.mem, sim.io,
+				sim.halted, sim.exit_code) = saved
+		for error, lanes in errors.items():
+			m = numpy.zeros(self.lanes, bool)
+			m[lanes] = True
+			self.fail(m, '%s at 0x%08x' % (error, c[8]))
+		if halted.any():
+			self.finish(halted, codes)
+		return self.jump(targets)
+
+	def syscall(self, c):
+		'''
+		performs output and exit syscalls for all lanes at once when they
+		agree on $v0, and any other syscall lane by lane
+		'''
+		A = self.active
+		v0 = numpy.unique(self.regs[2][A])
+		call = int(v0[0]) if len(v0) == 1 else None
+		a0 = self.regs[4]
+		lanes = numpy.flatnonzero(A)
+		if call == 1:
+			for k in lanes:
+				self.out[k] += b'%d' % s32(int(a0[k]))
+		elif call == 4:
+			for k in lanes:
+				self.out[k] += self.lane_string(k, int(a0[k]))
+		elif call == 11:
+			for k in lanes:
+				self.out[k].append(int(a0[k]) & 0xff)
+		elif call == 34:
+			for k in lanes:
+				self.out[k] += b'0x%08x' % int(a0[k])
+		elif call == 36:
+			for k in lanes:
+				self.out[k] += b'%d' % int(a0[k])
+		elif call == 10:
+			self.finish(A.copy())
+		elif call == 17:
+			self.finish(A.copy(), self.signed(4))
+		else: # input, files, sbrk or lanes that disagree
+			return self.each_lane(c)
+
+	def run(self):
+		'''runs the lanes until all of them have stopped'''
+		sim = self.sim
+		pc = self.pc
+		while self.active.any():
+			if self.max_steps and self.steps >= self.max_steps:
+				self.finish(self.active.copy())
+				break
+			if pc == sim.text_end: # dropped off the bottom
+				self.finish(self.active.copy())
+				break
+			i = (pc - sim.text_start) >> 2
+			if pc & 3 or not 0 <= i < len(sim.text):
+				self.finish(self.active.copy(),
+					error='Jump to invalid address 0x%08x' % pc)
+				break
+			c = sim.predecode(i)
+			op = vector_ops.get(sim.names[i])
+			self.steps += 1
+			self.pc = pc
+			t = op(self, c) if op is not None else self.each_lane(c)
+			pc = pc + 4 if t is None else t
+		self.pc = pc
+		return self.results
+
+class LaneMemory(object):
+	'''
+	one lane's view of the memory of a Lockstep, with the PagedMemory
+	methods used by the command handlers and syscalls
+	'''
+	def __init__(self, lk, k):
+		self.lk = lk
+		self.k = k
+
+	def load_word(self, addr):
+		if addr & 3:
+			raise SimError('Unaligned word load from 0x%08x' % addr)
+		vec = self.lk.words.get(addr >> 2)
+		return int(vec[self.k]) if vec is not None else self.lk.base.load_word(addr)
+
+	def store_word(self, addr, val):
+		if addr & 3:
+			raise SimError('Unaligned word store to 0x%08x' % addr)
+		self.lk.vector(addr >> 2)[self.k] = val & mask32
+
+	def load_half(self, addr):
+		if addr & 1:
+			raise SimError('Unaligned halfword load from 0x%08x' % addr)
+		return (self.load_word(addr & ~3) >> 8*(addr & 3)) & 0xffff
+
+	def store_half(self, addr, val):
+		if addr & 1:
+			raise SimError('Unaligned halfword store to 0x%08x' % addr)
+		self.store_part(addr, val, 0xffff)
+
+	def load_byte(self, addr):
+		return (self.load_word(addr & ~3) >> 8*(addr & 3)) & 0xff
+
+	def store_byte(self, addr, val):
+		self.store_part(addr, val, 0xff)
+
+	def store_part(self, addr, val, mask):
+		'''writes the bits of val in mask to the word holding addr, little-endian'''
+		shift = 8*(addr & 3)
+		w = self.load_word(addr & ~3)
+		self.store_word(addr & ~3, w & ~(mask << shift) | (val & mask) << shift)
+
+	def load_bytes(self, addr, n):
+		return self.lk.lane_bytes(self.k, addr, n)
+
+	def store_bytes(self, addr, data):
+		for j, b in enumerate(bytes(data)):
+			self.store_byte((addr + j) & mask32, b)
+
+	def load_string(self, addr):
+		return self.lk.lane_string(self.k, addr)
+
+# vector versions of the command handlers, taking a Lockstep
+
+def vop_nop(lk, c):
+	pass
+
+def vop_add(lk, c):
+	v = lk.signed(c[1]).astype(numpy.int64) + lk.signed(c[2])
+	lk.check_overflow(v)
+	lk.put(c[3], v)
+
+def vop_addu(lk, c):
+	lk.put(c[3], lk.regs[c[1]] + lk.regs[c[2]])
+
+def vop_sub(lk, c):
+	v = lk.signed(c[1]).astype(numpy.int64) - lk.signed(c[2])
+	lk.check_overflow(v)
+	lk.put(c[3], v)
+
+def vop_subu(lk, c):
+	lk.put(c[3], lk.regs[c[1]] - lk.regs[c[2]])
+
+def vop_and(lk, c):
+	lk.put(c[3], lk.regs[c[1]] & lk.regs[c[2]])
+
+def vop_or(lk, c):
+	lk.put(c[3], lk.regs[c[1]] | lk.regs[c[2]])
+
+def vop_xor(lk, c):
+	lk.put(c[3], lk.regs[c[1]] ^ lk.regs[c[2]])
+
+def vop_nor(lk, c):
+	lk.put(c[3], ~(lk.regs[c[1]] | lk.regs[c[2]]))
+
+def vop_slt(lk, c):
+	lk.put(c[3], lk.signed(c[1]) < lk.signed(c[2]))
+
+def vop_sltu(lk, c):
+	lk.put(c[3], lk.regs[c[1]] < lk.regs[c[2]])
+
+def vop_sll(lk, c):
+	lk.put(c[3], lk.regs[c[2]] << numpy.uint32(c[4]))
+
+def vop_srl(lk, c):
+	lk.put(c[3], lk.regs[c[2]] >> numpy.uint32(c[4]))
+
+def vop_sra(lk, c):
+	lk.put(c[3], lk.signed(c[2]) >> numpy.int32(c[4]))
+
+def vop_sllv(lk, c):
+	lk.put(c[3], lk.regs[c[2]] << (lk.regs[c[1]] & 31))
+
+def vop_srlv(lk, c):
+	lk.put(c[3], lk.regs[c[2]] >> (lk.regs[c[1]] & 31))
+
+def vop_srav(lk, c):
+	lk.put(c[3], lk.signed(c[2]) >> (lk.regs[c[1]] & 31).view(numpy.int32))
+
+def vop_addi(lk, c):
+	v = lk.signed(c[1]).astype(numpy.int64) + c[6]
+	lk.check_overflow(v)
+	lk.put(c[2], v)
+
+def vop_addiu(lk, c):
+	lk.put(c[2], lk.regs[c[1]] + numpy.uint32(c[6] & mask32))
+
+def vop_andi(lk, c):
+	lk.put(c[2], lk.regs[c[1]] & numpy.uint32(c[5]))
+
+def vop_ori(lk, c):
+	lk.put(c[2], lk.regs[c[1]] | numpy.uint32(c[5]))
+
+def vop_xori(lk, c):
+	lk.put(c[2], lk.regs[c[1]] ^ numpy.uint32(c[5]))
+
+def vop_slti(lk, c):
+	lk.put(c[2], lk.signed(c[1]) < numpy.int32(c[6]))
+
+def vop_sltiu(lk, c):
+	lk.put(c[2], lk.regs[c[1]] < numpy.uint32(c[6] & mask32))
+
+def vop_lui(lk, c):
+	lk.put(c[2], numpy.uint32(c[5] << 16))
+
+def vop_mult(lk, c):
+	p = lk.signed(c[1]).astype(numpy.int64) * lk.signed(c[2])
+	lk.put_hilo(p.view(numpy.uint64))
+
+def vop_multu(lk, c):
+	lk.put_hilo(lk.regs[c[1]].astype(numpy.uint64) * lk.regs[c[2]])
+
+def vop_mul(lk, c):
+	lk.put(c[3], lk.regs[c[1]] * lk.regs[c[2]])
+
+def vop_div(lk, c):
+	a = lk.signed(c[1]).astype(numpy.int64)
+	b = lk.signed(c[2]).astype(numpy.int64)
+	ok = lk.active & (b != 0) # dividing by zero leaves HI/LO alone
+	b = numpy.where(b == 0, 1, b)
+	q = numpy.abs(a) // numpy.abs(b) * numpy.where((a < 0) != (b < 0), -1, 1)
+	numpy.copyto(lk.lo, q, casting='unsafe', where=ok)
+	numpy.copyto(lk.hi, a - q * b, casting='unsafe', where=ok)
+
+def vop_divu(lk, c):
+	a, b = lk.regs[c[1]], lk.regs[c[2]]
+	ok = lk.active & (b != 0)
+	b = numpy.where(b == 0, 1, b).astype(numpy.uint32)
+	numpy.copyto(lk.lo, a // b, where=ok)
+	numpy.copyto(lk.hi, a % b, where=ok)
+
+def vop_mfhi(lk, c):
+	lk.put(c[3], lk.hi)
+
+def vop_mflo(lk, c):
+	lk.put(c[3], lk.lo)
+
+def vop_mthi(lk, c):
+	numpy.copyto(lk.hi, lk.regs[c[1]], where=lk.active)
+
+def vop_mtlo(lk, c):
+	numpy.copyto(lk.lo, lk.regs[c[1]], where=lk.active)
+
+def vop_movn(lk, c):
+	if c[3]:
+		numpy.copyto(lk.regs[c[3]], lk.regs[c[1]],
+			where=lk.active & (lk.regs[c[2]] != 0))
+
+def vop_movz(lk, c):
+	if c[3]:
+		numpy.copyto(lk.regs[c[3]], lk.regs[c[1]],
+			where=lk.active & (lk.regs[c[2]] == 0))
+
+def vop_beq(lk, c):
+	return lk.branch(lk.regs[c[1]] == lk.regs[c[2]], c)
+
+def vop_bne(lk, c):
+	return lk.branch(lk.regs[c[1]] != lk.regs[c[2]], c)
+
+def vop_bgez(lk, c):
+	return lk.branch(lk.signed(c[1]) >= 0, c)
+
+def vop_bgtz(lk, c):
+	return lk.branch(lk.signed(c[1]) > 0, c)
+
+def vop_blez(lk, c):
+	return lk.branch(lk.signed(c[1]) <= 0, c)
+
+def vop_bltz(lk, c):
+	return lk.branch(lk.signed(c[1]) < 0, c)
+
+def vop_j(lk, c):
+	return c[7]
+
+def vop_jal(lk, c):
+	lk.put(31, numpy.uint32(c[8] + 4))
+	return c[7]
+
+def vop_jr(lk, c):
+	return lk.jump(lk.regs[c[1]])
+
+def vop_jalr(lk, c):
+	targets = lk.regs[c[1]].copy()
+	lk.put(c[3], numpy.uint32(c[8] + 4))
+	return lk.jump(targets)
+
+def vop_lw(lk, c):
+	lk.put(c[2], lk.load(lk.address(c)))
+
+def vop_lbu(lk, c):
+	addrs = lk.address(c)
+	lk.put(c[2], (lk.load(addrs, 1) >> ((addrs & 3) << 3)) & 0xff)
+
+def vop_lb(lk, c):
+	addrs = lk.address(c)
+	b = ((lk.load(addrs, 1) >> ((addrs & 3) << 3)) & 0xff).astype(numpy.int32)
+	lk.put(c[2], (b ^ 0x80) - 0x80)
+
+def vop_lhu(lk, c):
+	addrs = lk.address(c)
+	lk.put(c[2], (lk.load(addrs, 2) >> ((addrs & 3) << 3)) & 0xffff)
+
+def vop_lh(lk, c):
+	addrs = lk.address(c)
+	h = ((lk.load(addrs, 2) >> ((addrs & 3) << 3)) & 0xffff).astype(numpy.int32)
+	lk.put(c[2], (h ^ 0x8000) - 0x8000)
+
+def vop_sw(lk, c):
+	lk.store(lk.address(c), lk.regs[c[2]])
+
+def vop_sh(lk, c):
+	lk.store(lk.address(c), lk.regs[c[2]], 16)
+
+def vop_sb(lk, c):
+	lk.store(lk.address(c), lk.regs[c[2]], 8)
+
+def vop_syscall(lk, c):
+	lk.syscall(c)
+
+vector_ops = dict((name[4:], f) for name, f in list(globals().items())
+				if name.startswith('vop_'))
+
+def cache_arg(arg):
+	'''argparse type for SIZE:WAYS:LINE[:POLICY] cache geometries, in bytes'''
+	m = re.match('(\d+)(k?):(\d+):(\d+)(?::(lru|random))?$', arg, re.I)
+	if not m:
+		raise argparse.ArgumentTypeError('expected SIZE:WAYS:LINE[:lru|random], got %r' % arg)
+	size = int(m.group(1)) << (10 if m.group(2) else 0)
+	ways, line = int(m.group(3)), int(m.group(4))
+	if line < 4 or line & (line - 1) or not ways or size % (ways * line) \
+			or (size // (ways * line)) & (size // (ways * line) - 1):
+		raise argparse.ArgumentTypeError('cache lines and sets must be powers of two, '
+			'with SIZE a multiple of WAYS*LINE: %r' % arg)
+	return (size, ways, line, (m.group(5) or 'lru').lower())
+
+def range_arg(arg):
+	'''argparse type for LO:HI address ranges, inclusive'''
+	m = re.match('(0x[0-9a-f]+|\d+):(0x[0-9a-f]+|\d+)$', arg, re.I)
+	if not m:
+		raise argparse.ArgumentTypeError('expected LO:HI addresses, got %r' % arg)
+	return (int(m.group(1), 0), int(m.group(2), 0))
+
+def print_regs(sim):
+	'''prints the general purpose registers, HI, LO and PC'''
+	for i in range(0, 32, 4):
+		print('  '.join('%-5s %08x' % (mipster.regs[i+k], sim.regs[i+k])
+						for k in range(4)))
+	print('%-5s %08x  %-5s %08x  %-5s %08x' % ('hi', sim.hi, 'lo', sim.lo,
+											'pc', sim.pc))
+
+class PagedMemory(object):
+	'''
+	sparse little-endian (as in MARS) memory of 4 KiB bytearray pages,
+	allocated when first written; unwritten memory reads as zeros
+	'''
+	def __init__(self):
+		self.pages = {} # page number -> bytearray
+		self.mapped = None # snapshot mapping holding pages not yet copied
+		self.lazy = {} # page number -> offset into self.mapped
+		self.last = -1 # number of the most recently used page
+		self.last_page = None
+		self.watches = [] # (first, last address, also watch reads)
+		self.watched = set() # numbers of pages holding watched addresses
+		self.watching = True
+
+	def page(self, addr):
+		'''returns the page holding addr, allocating it if needed'''
+		num = addr >> page_bits
+		if num != self.last:
+			if num in self.watched:
+				self.check(addr, True)
+			page = self.pages.get(num)
+			if page is None:
+				page = self.pages[num] = self.fault(num)
+			if num in self.watched: # keep watched pages out of the cache
+				return page
+			self.last = num
+			self.last_page = page
+		return self.last_page
+
+	def watch(self, first, last, reads=False):
+		'''watches writes (and optionally reads) of addresses first to last'''
+		self.watches.append((first, last, reads))
+		self.watched.update(range(first >> page_bits, (last >> page_bits) + 1))
+		self.last = -1
+
+	def unwatch(self):
+		'''removes all watchpoints'''
+		self.watches = []
+		self.watched = set()
+
+	def check(self, addr, write):
+		'''raises WatchHit if an access to addr is watched'''
+		if not self.watching:
+			return
+		for first, last, reads in self.watches:
+			if first <= addr <= last and (write or reads):
+				raise WatchHit(addr, write)
+
+	def fault(self, num):
+		'''returns a new page, copied from the snapshot mapping if it has one'''
+		off = self.lazy.pop(num, None)
+		if off is None:
+			return bytearray(page_size)
+		return bytearray(self.mapped[off:off + page_size])
+
+	def page_numbers(self):
+		'''returns the sorted numbers of all pages with contents'''
+		return sorted(set(self.pages) | set(self.lazy))
+
+	def page_data(self, num):
+		'''returns the contents of a page without copying it out of a mapping'''
+		if num in self.pages:
+			return self.pages[num]
+		off = self.lazy.get(num)
+		if off is None:
+			return zero_page
+		return memoryview(self.mapped)[off:off + page_size]
+
+	def map_pages(self, mapped, nums, offset):
+		'''
+		replaces the memory with pages stored back to back in mapped from
+		offset; each page is only copied out when it is first used
+		'''
+		self.pages = {}
+		self.mapped = mapped
+		self.lazy = dict((n, offset + i*page_size) for i, n in enumerate(nums))
+		self.last = -1
+		self.last_page = None
+
+	def peek(self, addr):
+		'''returns the page holding addr without allocating it'''
+		num = addr >> page_bits
+		if num == self.last:
+			return self.last_page
+		if num in self.watched:
+			self.check(addr, False)
+		page = self.pages.get(num)
+		if page is None:
+			if num not in self.lazy:
+				return zero_page
+			page = self.pages[num] = self.fault(num)
+		if num in self.watched:
+			return page
+		self.last = num
+		self.last_page = page
+		return page
+
+	def load_word(self, addr):
+		if addr & 3:
+			raise SimError('Unaligned word load from 0x%08x' % addr)
+		return word.unpack_from(self.peek(addr), addr & page_mask)[0]
+
+	def store_word(self, addr, val):
+		if addr & 3:
+			raise SimError('Unaligned word store to 0x%08x' % addr)
+		word.pack_into(self.page(addr), addr & page_mask, val)
+
+	def load_half(self, addr):
+		if addr & 1:
+			raise SimError('Unaligned halfword load from 0x%08x' % addr)
+		return half.unpack_from(self.peek(addr), addr & page_mask)[0]
+
+	def store_half(self, addr, val):
+		if addr & 1:
+			raise SimError('Unaligned halfword store to 0x%08x' % addr)
+		half.pack_into(self.page(addr), addr & page_mask, val & 0xffff)
+
+	def load_byte(self, addr):
+		return self.peek(addr)[addr & page_mask]
+
+	def store_byte(self, addr, val):
+		self.page(addr)[addr & page_mask] = val & 0xff
+
+	def load_bytes(self, addr, n):
+		'''reads n bytes starting at addr'''
+		out = bytearray()
+		while n > 0:
+			off = addr & page_mask
+			k = min(n, page_size - off)
+			out += self.peek(addr)[off:off + k]
+			addr = (addr + k) & mask32
+			n -= k
+		return bytes(out)
+
+	def store_bytes(self, addr, data):
+		'''writes a bytes-like object starting at addr'''
+		data = memoryview(data).cast('B')
+		while data:
+			off = addr & page_mask
+			k = min(len(data), page_size - off)
+			self.page(addr)[off:off + k] = data[:k]
+			addr = (addr + k) & mask32
+			data = data[k:]
+
+	def store_words(self, addr, words):
+		'''writes a sequence of 32-bit words starting at addr'''
+		a = array.array('I', words)
+		if sys.byteorder != 'little':
+			a.byteswap()
+		self.store_bytes(addr, a)
+
+	def load_string(self, addr):
+		'''reads a NUL terminated string as bytes'''
+		out = bytearray()
+		while True:
+			off = addr & page_mask
+			page = self.peek(addr)
+			end = page.find(0, off)
+			if end >= 0:
+				out += page[off:end]
+				return bytes(out)
+			out += page[off:]
+			addr = (addr + page_size - off) & mask32
+
+class SyscallIO(object):
+	'''
+	the SPIM/MARS system calls; output is collected in a buffer that is
+	written out when it grows past bufsize, when the program reads input and
+	when the simulation stops, and input that isn't a terminal is read all at
+	once. stdin and stdout may be any binary files, e.g. io.BytesIO for
+	running programs in memory
+	'''
+	def __init__(self, stdin=None, stdout=None, bufsize=1 << 16):
+		self.stdin = stdin if stdin is not None else sys.stdin.buffer
+		self.stdout = stdout if stdout is not None else sys.stdout.buffer
+		self.bufsize = bufsize
+		self.out = bytearray()
+		self.input = b''
+		self.pos = 0 # read position in self.input
+		self.eof = False
+		self.files = {} # descriptor -> file opened by the program
+		self.brk = heap_addr
+		self.calls = {
+			1: self.print_int, 2: self.print_float, 3: self.print_double,
+			4: self.print_string, 5: self.read_int, 6: self.read_float,
+			7: self.read_double, 8: self.read_string, 9: self.sbrk,
+			10: self.exit, 11: self.print_char, 12: self.read_char,
+			13: self.open, 14: self.read, 15: self.write, 16: self.close,
+			17: self.exit2, 34: self.print_hex, 35: self.print_bin,
+			36: self.print_uint,
+		}
+
+	def syscall(self, sim):
+		'''performs the system call selected by $v0'''
+		call = self.calls.get(sim.regs[2])
+		if call is None:
+			raise SimError('Unknown syscall %d' % sim.regs[2])
+		call(sim)
+
+	def emit(self, data):
+		self.out += data
+		if len(self.out) >= self.bufsize:
+			self.flush()
+
+	def flush(self):
+		'''writes out buffered output'''
+		if self.out:
+			self.stdout.write(self.out)
+			del self.out[:]
+		if hasattr(self.stdout, 'flush'):
+			self.stdout.flush()
+
+	def fill(self):
+		'''
+		reads more input: everything at once from files and pipes, a line at
+		a time from terminals
+		returns:
+			False at end of input
+		'''
+		if self.eof:
+			return False
+		self.flush() # show prompts before waiting for input
+		isatty = getattr(self.stdin, 'isatty', None)
+		more = self.stdin.readline() if isatty and isatty() else self.stdin.read()
+		if not more:
+			self.eof = True
+			return False
+		self.input = self.input[self.pos:] + more
+		self.pos = 0
+		return True
+
+	def read_line(self, limit=None):
+		'''returns the next line of input, with its newline, as bytes'''
+		while True:
+			end = self.input.find(b'\n', self.pos)
+			if end >= 0 or not self.fill():
+				break
+		end = len(self.input) if end < 0 else end + 1
+		if limit is not None:
+			end = min(end, self.pos + limit)
+		line = self.input[self.pos:end]
+		self.pos = end
+		return line
+
+	def read_bytes(self, n):
+		'''returns up to n bytes of input'''
+		while len(self.input) - self.pos < n and self.fill():
+			pass
+		data = self.input[self.pos:self.pos + n]
+		self.pos += len(data)
+		return data
+
+	def read_number(self, convert):
+		line = self.read_line()
+		try:
+			return convert(line.strip().decode('latin-1'))
+		except ValueError:
+			raise SimError('Invalid input %r' % line.strip().decode('latin-1'))
+
+	def print_int(self, sim):
+		self.emit(b'%d' % s32(sim.regs[4]))
+
+	def print_uint(self, sim):
+		self.emit(b'%d' % sim.regs[4])
+
+	def print_hex(self, sim):
+		self.emit(b'0x%08x' % sim.regs[4])
+
+	def print_bin(self, sim):
+		self.emit(b'%032d' % int(bin(sim.regs[4])[2:]))
+
+	def print_float(self, sim):
+		self.emit(format_float(get_s(sim, 12), single).encode())
+
+	def print_double(self, sim):
+		self.emit(format_float(get_d(sim, 12), double).encode())
+
+	def print_string(self, sim):
+		self.emit(sim.mem.load_string(sim.regs[4]))
+
+	def print_char(self, sim):
+		self.emit(bytes((sim.regs[4] & 0xff,)))
+
+	def read_int(self, sim):
+		sim.regs[2] = self.read_number(int) & mask32
+
+	def read_float(self, sim):
+		put_s(sim, 0, self.read_number(float))
+
+	def read_double(self, sim):
+		put_d(sim, 0, self.read_number(float))
+
+	def read_string(self, sim):
+		'''reads at most $a1 - 1 bytes of a line into $a0, NUL terminated'''
+		n = s32(sim.regs[5])
+		if n < 1:
+			return
+		sim.mem.store_bytes(sim.regs[4], self.read_line(n - 1) + b'\0')
+
+	def read_char(self, sim):
+		c = self.read_bytes(1)
+		sim.regs[2] = c[0] if c else 0
+
+	def sbrk(self, sim):
+		n = s32(sim.regs[4])
+		sim.regs[2] = self.brk
+		self.brk = (self.brk + n + 3) & ~3 & mask32
+
+	def exit(self, sim):
+		sim.halted = True
+
+	def exit2(self, sim):
+		sim.exit_code = s32(sim.regs[4])
+		sim.halted = True
+
+	def open(self, sim):
+		'''opens the file named by $a0 with flags $a1 (0 read, 1 write, 9 append)'''
+		mode = {0: 'rb', 1: 'wb', 9: 'ab'}.get(sim.regs[5])
+		try:
+			if mode is None:
+				raise IOError()
+			f = open(sim.mem.load_string(sim.regs[4]).decode('latin-1'), mode)
+		except IOError:
+			sim.regs[2] = mask32 # -1
+			return
+		fd = 3
+		while fd in self.files:
+			fd += 1
+		self.files[fd] = f
+		sim.regs[2] = fd
+
+	def read(self, sim):
+		'''reads up to $a2 bytes from descriptor $a0 into $a1'''
+		fd, n = sim.regs[4], s32(sim.regs[6])
+		if fd == 0:
+			data = self.read_bytes(max(n, 0))
+		elif fd in self.files:
+			try:
+				data = self.files[fd].read(max(n, 0))
+			except IOError:
+				data = None
+		else:
+			data = None
+		if data is None:
+			sim.regs[2] = mask32
+			return
+		sim.mem.store_bytes(sim.regs[5], data)
+		sim.regs[2] = len(data)
+
+	def write(self, sim):
+		'''writes $a2 bytes from $a1 to descriptor $a0'''
+		fd, n = sim.regs[4], max(s32(sim.regs[6]), 0)
+		data = sim.mem.load_bytes(sim.regs[5], n)
+		try:
+			if fd == 1:
+				self.emit(data)
+			elif fd == 2:
+				self.flush()
+				sys.stderr.buffer.write(data)
+				sys.stderr.flush()
+			elif fd in self.files:
+				self.files[fd].write(data)
+			else:
+				raise IOError()
+		except IOError:
+			sim.regs[2] = mask32
+			return
+		sim.regs[2] = n
+
+	def close(self, sim):
+		f = self.files.pop(sim.regs[4], None)
+		if f is not None:
+			f.close()
+
+class Simulator(object):
+	'''
+	executes a program one basic block at a time; each text word is decoded
+	once into a tuple of (handler, rs, rt, rd, sa, imm, sign extended imm,
+	branch or jump target, address), and blocks of these tuples are cached
+	by their start address
+	'''
+	def __init__(self, isa, text, data, delay_slots=False,
+				text_start=mipster.text_start_addr, io=None):
+		self.isa = isa
+		self.decoder = make_decoder(isa)
+		self.ops = dict(ops)
+		self.text = text
+		self.text_start = text_start
+		self.text_end = text_start + 4*len(text)
+		self.data = data
+		self.delay_slots = delay_slots
+		self.link = 8 if delay_slots else 4 # return address offset
+		self.reset(io)
+		self.names = [None] * len(text) # decoded command names
+		self.decoded = [None] * len(text)
+		self.blocks = {} # start address -> (commands, next address, first
+		                 # word index, terminating word index, 'call'/'return'/None)
+		self.profiler = None
+		self.block_hooks = [] # called with each executed block and its target
+		self.breakpoints = set() # addresses to stop at
+		self.stopped = None # why the last run stopped early, if it did
+		self.pending = None # where to go after the delay slot being stepped
+
+	def reset(self, io=None):
+		'''
+		puts the machine in its initial state: registers cleared but for
+		$gp and $sp, and memory holding only .text and .data. The decoded
+		commands are kept, so one Simulator can run many inputs
+		'''
+		self.regs = [0] * 32
+		self.regs[28] = global_addr
+		self.regs[29] = stack_addr
+		self.hi = self.lo = 0
+		self.fregs = [0] * 32
+		self.fcc = [False] * 8
+		self.pc = self.text_start
+		self.mem = PagedMemory()
+		self.mem.store_words(self.text_start, self.text)
+		self.mem.store_words(data_addr, self.data)
+		self.io = io if io is not None else SyscallIO()
+		self.halted = False
+		self.exit_code = 0
+		self.steps = 0
+
+	def predecode(self, i):
+		'''returns the decoded command tuple of text word i'''
+		if self.decoded[i] is not None:
+			return self.decoded[i]
+		w = self.text[i]
+		pc = self.text_start + 4*i
+		d = decode(self.decoder, w)
+		name = d[0] if d else None
+		if name is None:
+			func = op_illegal
+		else:
+			func = self.ops.get(name, op_unimplemented)
+		rs = (w >> 21) & 31
+		rt = (w >> 16) & 31
+		rd = (w >> 11) & 31
+		imm = w & 0xffff
+		simm = imm - 0x10000 if imm & 0x8000 else imm
+		target = None
+		if name in mipster.branch_cmds:
+			target = (pc + 4 + (simm << 2)) & mask32
+		elif name in ('j', 'jal'):
+			target = ((pc + 4) & 0xf0000000) | ((w & 0x3ffffff) << 2)
+		if name in rd_dest_cmds and rd == 0 or name in rt_dest_cmds and rt == 0:
+			func = self.ops['nop'] # writes to $zero are discarded
+		self.names[i] = name
+		self.decoded[i] = (func, rs, rt, rd, (w >> 6) & 31, imm, simm, target, pc)
+		return self.decoded[i]
+
+	def build_block(self, pc):
+		'''decodes and caches the basic block starting at pc'''
+		i = (pc - self.text_start) >> 2
+		if pc & 3 or not 0 <= i < len(self.text):
+			raise SimError('Jump to invalid address 0x%08x' % pc)
+		cmds = []
+		j = i
+		term = None
+		while j < len(self.text):
+			if j > i and self.text_start + 4*j in self.breakpoints:
+				break # so that breakpoints always start blocks
+			cmds.append(self.predecode(j))
+			name = self.names[j]
+			j += 1
+			if name is not None and mipster.is_control(name):
+				term = j - 1
+				if self.delay_slots and name != 'syscall' and j < len(self.text) \
+						and self.text_start + 4*j not in self.breakpoints:
+					cmds.append(self.predecode(j))
+					j += 1
+				break
+		kind = None
+		if term is None:
+			term = j - 1
+		elif self.names[term] in mipster.link_cmds:
+			kind = 'call'
+		elif self.names[term] == 'jr' and self.decoded[term][1] == 31:
+			kind = 'return'
+		block = (tuple(cmds), self.text_start + 4*j, i, term, kind)
+		self.blocks[pc] = block
+		return block
+
+	def run(self, max_steps=0):
+		'''
+		runs until the program exits, runs off the end of .text or has
+		executed at least max_steps commands (0 = no limit)
+		returns:
+			the number of commands executed
+		'''
+		if self.pending is not None: # finish stepping a delay slot first
+			self.step()
+		blocks = self.blocks
+		hooks = self.block_hooks
+		breaks = self.breakpoints
+		pc = self.pc
+		start = pc # a breakpoint here was already reported
+		steps = 0
+		cmd = None
+		b = None
+		target = None
+		self.stopped = None
+		try:
+			while not self.halted:
+				if pc == self.text_end: # dropped off the bottom
+					self.halted = True
+					break
+				if breaks and pc in breaks and pc != start:
+					self.stopped = 'Breakpoint at 0x%08x' % pc
+					break
+				start = None
+				b = blocks.get(pc) # None while a failing block is built
+				if b is None:
+					b = self.build_block(pc)
+				target = None
+				for cmd in b[0]:
+					t = cmd[0](self, cmd)
+					if t is not None:
+						target = t
+				steps += len(b[0])
+				for hook in hooks:
+					hook(b, target)
+				pc = b[1] if target is None else target
+				if target is not None and breaks and b[1] in breaks and self.delay_slots \
+						and b[1] == self.text_start + 4*b[3] + 4 and self.names[b[3]] != 'syscall':
+					# build_block() left out a delay slot holding a breakpoint
+					self.pending = target
+					pc = b[1]
+				if max_steps and steps >= max_steps:
+					break
+		except WatchHit as ex: # stop before the command making the access
+			steps += b[0].index(cmd)
+			pc = cmd[8]
+			if target is not None: # in the delay slot of a taken branch
+				self.pending = target
+			self.stopped = '%s at 0x%08x' % (ex, pc)
+		except SimError as ex:
+			if cmd and b is not None: # count the commands before the failing one
+				steps += b[0].index(cmd)
+			pc = cmd[8] if cmd else pc
+			raise SimError('%s at 0x%08x' % (ex, pc))
+		finally:
+			self.pc = pc
+			self.steps += steps
+			self.io.flush()
+		return steps
+
+	def step(self):
+		'''executes the single command at pc, without block hooks'''
+		if self.halted:
+			return
+		if self.pc == self.text_end:
+			self.halted = True
+			return
+		i = (self.pc - self.text_start) >> 2
+		if self.pc & 3 or not 0 <= i < len(self.text):
+			raise SimError('Jump to invalid address 0x%08x' % self.pc)
+		c = self.predecode(i)
+		try:
+			t = c[0](self, c)
+		except SimError as ex:
+			raise SimError('%s at 0x%08x' % (ex, self.pc))
+		finally:
+			self.io.flush()
+		self.steps += 1
+		pending, self.pending = self.pending, None
+		if pending is not None: # that was a delay slot
+			self.pc = pending
+		elif t is not None and self.delay_slots and self.names[i] != 'syscall':
+			self.pending = t
+			self.pc = c[8] + 4
+		else:
+			self.pc = c[8] + 4 if t is None else t
+
+	def set_breakpoint(self, addr, on=True):
+		'''adds or removes a breakpoint, re-forming blocks around it'''
+		if on:
+			self.breakpoints.add(addr)
+		else:
+			self.breakpoints.discard(addr)
+		self.blocks = {}
+
+	def save(self, filename):
+		'''
+		writes the machine state to a snapshot file: a header, the registers,
+		the numbers of the pages in use, then the pages themselves, page
+		aligned so restore can map them. The file is written under a temporary
+		name and then renamed, since its old contents may still be mapped
+		'''
+		nums = self.mem.page_numbers()
+		fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+			prefix=os.path.basename(filename) + '.', suffix='.tmp')
+		umask = os.umask(0)
+		os.umask(umask)
+		try:
+			os.chmod(tmp, 0o666 & ~umask) # as open() would have created it
+			with os.fdopen(fd, 'wb') as f:
+				f.write(snapshot_header.pack(snapshot_magic, self.text_start,
+					len(self.text), self.pc, self.hi, self.lo, self.halted,
+					self.exit_code, self.steps, len(nums), self.io.brk,
+					no_value if self.pending is None else self.pending))
+				f.write(snapshot_regs.pack(*(self.regs + self.fregs + self.fcc)))
+				table = array.array('I', nums)
+				if sys.byteorder != 'little':
+					table.byteswap()
+				f.write(table.tobytes())
+				f.write(bytes(-f.tell() % page_size))
+				for n in nums:
+					f.write(self.mem.page_data(n))
+			os.replace(tmp, filename)
+		except BaseException:
+			os.remove(tmp)
+			raise
+
+	def restore(self, filename):
+		'''
+		loads the machine state from a snapshot file of the same program;
+		memory pages are mapped, and only read when the program uses them
+		'''
+		with open(filename, 'rb') as f:
+			mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		size = snapshot_header.size + snapshot_regs.size
+		if len(mapped) < size or mapped[:8] != snapshot_magic:
+			raise SimError('%s is not a simulator snapshot' % filename)
+		header = snapshot_header.unpack_from(mapped)
+		(magic, text_start, text_words, pc, hi, lo, halted, exit_code,
+			steps, npages, brk, pending) = header
+		table = array.array('I', mapped[size:size + 4*npages])
+		if sys.byteorder != 'little':
+			table.byteswap()
+		offset = size + 4*npages
+		offset += -offset % page_size
+		if len(mapped) < offset + npages*page_size:
+			raise SimError('%s is truncated' % filename)
+		mem = PagedMemory()
+		mem.map_pages(mapped, table, offset)
+		text = [mem.load_word(text_start + 4*i) for i in range(text_words)]
+		if text_start != self.text_start or text != self.text:
+			raise SimError('%s is a snapshot of a different program' % filename)
+		regs = snapshot_regs.unpack_from(mapped, snapshot_header.size)
+		self.regs = list(regs[:32])
+		self.fregs = list(regs[32:64])
+		self.fcc = list(regs[64:])
+		self.pc, self.hi, self.lo = pc, hi, lo
+		self.halted = bool(halted)
+		self.exit_code = exit_code
+		self.steps = steps
+		self.io.brk = brk
+		self.pending = None if pending == no_value else pending
+		self.mem = mem
+
+	def hook(self, names, wrap):
+		'''
+		replaces the handlers of the named commands with wrap(name, handler),
+		and drops the decoded commands, which refer to the old handlers
+		'''
+		for name in names:
+			if name in self.ops:
+				self.ops[name] = wrap(name, self.ops[name])
+		self.decoded = [None] * len(self.text)
+		self.blocks = {}
+
+	def disassemble(self, i):
+		'''returns the assembly text of text word i'''
+		return disassemble(self.isa, self.decoder, self.text[i],
+						self.text_start + 4*i)
+
+class Profiler(object):
+	'''
+	counts how often each cached block runs, indexed by the text word it
+	starts at, how often each block's branch or jump is taken, and how many
+	commands run under each call stack, tracked through jal and jr $ra;
+	everything is updated once per block rather than per command
+	'''
+	def __init__(self, sim):
+		n = len(sim.text)
+		self.sim = sim
+		self.counts = array.array('L', [0]) * n
+		self.taken = array.array('L', [0]) * n
+		self.stack = 0 # current call stack id
+		self.parents = [0] # call stack id -> caller's stack id
+		self.funcs = [sim.pc] # call stack id -> function address
+		self.children = {} # (stack id, function address) -> stack id
+		self.instrs = [0] # call stack id -> commands executed
+
+	def block(self, b, target):
+		'''records one execution of block b, which jumped to target (or None)'''
+		self.counts[b[2]] += 1
+		self.instrs[self.stack] += len(b[0])
+		if target is not None:
+			self.taken[b[3]] += 1
+			if b[4] == 'call':
+				key = (self.stack, target)
+				stack = self.children.get(key)
+				if stack is None:
+					stack = self.children[key] = len(self.parents)
+					self.parents.append(self.stack)
+					self.funcs.append(target)
+					self.instrs.append(0)
+				self.stack = stack
+			elif b[4] == 'return':
+				self.stack = self.parents[self.stack]
+
+	def word_counts(self):
+		'''returns an array of execution counts per text word'''
+		counts = array.array('L', [0]) * len(self.counts)
+		for b in self.sim.blocks.values():
+			n = self.counts[b[2]]
+			if n:
+				for i in range(b[2], b[2] + len(b[0])):
+					counts[i] += n
+		return counts
+
+	def print_hot_spots(self, debug, top=20):
+		'''prints the labels (or blocks, without debug info) that ran the most'''
+		counts = self.word_counts()
+		start = self.sim.text_start
+		spots = collections.Counter()
+		if debug:
+			for i, n in enumerate(counts):
+				if n:
+					sym = debug.symbol(start + 4*i)
+					spots[sym[0] if sym else '0x%08x' % (start + 4*i)] += n
+		else:
+			for b in self.sim.blocks.values():
+				spots['0x%08x' % (start + 4*b[2])] += self.counts[b[2]] * len(b[0])
+		total = sum(counts) or 1
+		print('%12s %7s  %s' % ('commands', 'share', 'label' if debug else 'block'))
+		for name, n in spots.most_common(top):
+			print('%12d %6.2f%%  %s' % (n, 100.0 * n / total, name))
+
+	def write_collapsed(self, f, debug):
+		'''writes 'caller;callee count' lines, the input format of flamegraph.pl'''
+		names = [symbol_name(a, debug) for a in self.funcs]
+		out = []
+		for stack, n in enumerate(self.instrs):
+			if not n:
+				continue
+			frames = [names[stack]]
+			while stack:
+				stack = self.parents[stack]
+				frames.append(names[stack])
+			out.append('%s %d' % (';'.join(reversed(frames)), n))
+		f.write(''.join(x + '\n' for x in sorted(out)))
+
+	def write_annotated(self, f, debug):
+		'''writes each command with its execution and taken branch counts'''
+		counts = self.word_counts()
+		sources = {}
+		out = ['%10s %10s  %-8s  %-8s  %-30s %s'
+			% ('count', 'taken', 'address', 'word', 'command', 'source')]
+		for i, w in enumerate(self.sim.text):
+			addr = self.sim.text_start + 4*i
+			sym = debug.symbol(addr) if debug else None
+			if sym and not sym[1]:
+				out.append('%s:' % sym[0])
+			source = ''
+			line = debug.line(addr) if debug else None
+			if line:
+				if line[0] not in sources:
+					try:
+						with open(line[0], 'r') as src:
+							sources[line[0]] = src.read().splitlines()
+					except IOError:
+						sources[line[0]] = []
+				text = sources[line[0]]
+				source = '%d: %s' % (line[1], text[line[1]-1].strip()
+									if line[1] <= len(text) else '')
+			out.append(('%10d %10s  %08x  %08x  %-30s %s'
+				% (counts[i], self.taken[i] or '', addr, w,
+				self.sim.disassemble(i), source)).rstrip())
+		f.write('\n'.join(out) + '\n')
+
+class Cache(object):
+	'''
+	a set-associative cache of size bytes with LRU or random replacement;
+	the line numbers cached in each set are kept in one flat array, most
+	recently used first, and misses are counted per text word and
+	evictions per set
+	'''
+	def __init__(self, sim, size, ways, line, policy='lru'):
+		self.sim = sim
+		self.size, self.ways, self.line, self.policy = size, ways, line, policy
+		self.line_bits = line.bit_length() - 1
+		self.sets = size // (ways * line)
+		self.lines = array.array('q', [-1]) * (self.sets * ways)
+		self.random = random.Random(0) if policy == 'random' else None
+		self.accesses = 0
+		self.misses = 0
+		self.word_misses = array.array('L', [0]) * len(sim.text)
+		self.evictions = array.array('L', [0]) * self.sets
+
+	def access(self, addr, pc):
+		'''
+		looks up the line holding addr, filling it on a miss, for the command at pc
+		returns:
+			True on a hit
+		'''
+		self.accesses += 1
+		line = addr >> self.line_bits
+		ways = self.ways
+		lines = self.lines
+		s = (line & (self.sets - 1)) * ways
+		if lines[s] == line:
+			return True
+		for i in range(s + 1, s + ways):
+			if lines[i] == line:
+				if self.random is None: # move to the front
+					lines[s+1:i+1] = lines[s:i]
+					lines[s] = line
+				return True
+		self.misses += 1
+		self.word_misses[(pc - self.sim.text_start) >> 2] += 1
+		if self.random is None:
+			victim = s + ways - 1
+		else:
+			victim = s + ways - 1 if lines[s + ways - 1] < 0 else \
+				s + self.random.randrange(ways)
+		if lines[victim] >= 0:
+			self.evictions[s // ways] += 1
+		lines[s+1:victim+1] = lines[s:victim]
+		lines[s] = line
+		return False
+
+	def print_stats(self, debug, top=10):
+		'''prints the hit rate, the labels with the most misses and the sets with the most evictions'''
+		hits = self.accesses - self.misses
+		print('%s: %d B, %d-way, %d B lines, %s: %d accesses, %d misses, '
+			'%.2f%% hit rate' % (self.name, self.size, self.ways, self.line,
+			self.policy.upper(), self.accesses, self.misses,
+			100.0 * hits / (self.accesses or 1)))
+		if not self.misses:
+			return
+		labels = collections.Counter()
+		start = self.sim.text_start
+		for i, n in enumerate(self.word_misses):
+			if n:
+				sym = debug.symbol(start + 4*i) if debug else None
+				labels[sym[0] if sym else '0x%08x' % (start + 4*i)] += n
+		print('%12s  %s' % ('misses', 'label' if debug else 'command'))
+		for name, n in labels.most_common(top):
+			print('%12d  %s' % (n, name))
+		sets = sorted((n, i) for i, n in enumerate(self.evictions) if n)
+		if sets:
+			print('%12s  %s' % ('evictions', 'set'))
+			for n, i in sets[:-top-1:-1]:
+				print('%12d  %d' % (n, i))
+
+class ICache(Cache):
+	'''
+	an instruction cache, accessed once per line for each executed block;
+	the other fetches from the line are counted as hits
+	'''
+	name = 'I-cache'
+	def __init__(self, sim, *args):
+		Cache.__init__(self, sim, *args)
+		sim.block_hooks.append(self.fetch)
+		self.block_lines = {} # block start -> ((line address, pc), ...)
+
+	def fetch(self, b, target):
+		lines = self.block_lines.get(b[2])
+		if lines is None:
+			lines = self.block_lines[b[2]] = self.split(b)
+		for addr, pc in lines:
+			self.access(addr, pc)
+		self.accesses += len(b[0]) - len(lines)
+
+	def split(self, b):
+		'''returns the first address fetched from each cache line of block b'''
+		lines = []
+		for c in b[0]:
+			if not lines or c[8] >> self.line_bits != lines[-1][0] >> self.line_bits:
+				lines.append((c[8], c[8]))
+		return tuple(lines)
+
+class DCache(Cache):
+	'''
+	a write-allocate data cache, accessed by hooking the load and store
+	handlers
+	'''
+	name = 'D-cache'
+	def __init__(self, sim, *args):
+		Cache.__init__(self, sim, *args)
+		sim.hook(mipster.load_cmds + mipster.store_cmds, self.wrap)
+
+	def wrap(self, name, op):
+		def hooked(sim, c):
+			self.access((sim.regs[c[1]] + c[6]) & mask32, c[8])
+			return op(sim, c)
+		return hooked
+
+class Predictor(object):
+	'''
+	a branch predictor, attached by hooking the conditional branch handlers;
+	counts executions and mispredictions per text word. Subclasses implement
+	predict(command) and update(command, taken)
+	'''
+	name = None
+	def __init__(self, sim, bits=10, history=8):
+		self.sim = sim
+		self.executed = array.array('L', [0]) * len(sim.text)
+		self.mispredicted = array.array('L', [0]) * len(sim.text)
+		sim.hook(mipster.branch_cmds, self.wrap)
+
+	def wrap(self, name, op):
+		start = self.sim.text_start
+		def hooked(sim, c):
+			t = op(sim, c)
+			i = (c[8] - start) >> 2
+			self.executed[i] += 1
+			taken = t is not None
+			if self.predict(c) != taken:
+				self.mispredicted[i] += 1
+			self.update(c, taken)
+			return t
+		return hooked
+
+	def predict(self, c):
+		return False
+
+	def update(self, c, taken):
+		pass
+
+	def print_stats(self, debug, top=10):
+		'''prints the misprediction rate and the worst branches and labels'''
+		total = sum(self.executed)
+		wrong = sum(self.mispredicted)
+		print('%s predictor: %d branches, %d mispredicted, %.2f%% accuracy'
+			% (self.name, total, wrong, 100.0 * (total - wrong) / (total or 1)))
+		if not wrong:
+			return
+		start = self.sim.text_start
+		branches = sorted((n, i) for i, n in enumerate(self.mispredicted) if n)
+		print('%12s %12s  %-10s  %s' % ('mispredicted', 'executed', 'address', 'command'))
+		for n, i in branches[:-top-1:-1]:
+			print('%12d %12d  0x%08x  %s' % (n, self.executed[i], start + 4*i,
+											self.sim.disassemble(i)))
+		if debug:
+			labels = collections.Counter()
+			for n, i in branches:
+				sym = debug.symbol(start + 4*i)
+				labels[sym[0] if sym else '0x%08x' % (start + 4*i)] += n
+			print('%12s  %s' % ('mispredicted', 'label'))
+			for name, n in labels.most_common(top):
+				print('%12d  %s' % (n, name))
+
+class NotTakenPredictor(Predictor):
+	'''predicts every branch falls through'''
+	name = 'not-taken'
+
+class BackwardTakenPredictor(Predictor):
+	'''predicts backward branches (loops) taken and forward branches not'''
+	name = 'btfn'
+	def predict(self, c):
+		return c[7] <= c[8]
+
+class BimodalPredictor(Predictor):
+	'''a table of 2-bit saturating counters indexed by branch address'''
+	name = 'bimodal'
+	def __init__(self, sim, bits=10, history=8):
+		Predictor.__init__(self, sim, bits, history)
+		self.mask = (1 << bits) - 1
+		self.counters = array.array('B', [1]) * (1 << bits) # weakly not taken
+
+	def index(self, c):
+		return (c[8] >> 2) & self.mask
+
+	def predict(self, c):
+		return self.counters[self.index(c)] >= 2
+
+	def update(self, c, taken):
+		i = self.index(c)
+		n = self.counters[i]
+		if taken:
+			if n < 3:
+				self.counters[i] = n + 1
+		elif n:
+			self.counters[i] = n - 1
+
+class GsharePredictor(BimodalPredictor):
+	'''2-bit counters indexed by branch address xor the global branch history'''
+	name = 'gshare'
+	def __init__(self, sim, bits=10, history=8):
+		BimodalPredictor.__init__(self, sim, bits, history)
+		self.history = 0
+		self.history_mask = (1 << history) - 1
+
+	def index(self, c):
+		return ((c[8] >> 2) ^ self.history) & self.mask
+
+	def update(self, c, taken):
+		BimodalPredictor.update(self, c, taken)
+		self.history = ((self.history << 1) | taken) & self.history_mask
+
+predictors = {
+	'not-taken': NotTakenPredictor,
+	'btfn': BackwardTakenPredictor,
+	'bimodal': BimodalPredictor,
+	'gshare': GsharePredictor,
+}
+
+class Debugger(cmd.Cmd):
+	'''
+	an interactive debugger; breakpoints are checked only where blocks
+	start (blocks are split at them) and watchpoints only on accesses to
+	pages holding watched addresses, so running between stops is nearly as
+	fast as running freely
+	'''
+	prompt = '(mipsim) '
+
+	def __init__(self, sim, debug=None):
+		cmd.Cmd.__init__(self)
+		self.sim = sim
+		self.debug = debug
+		self.at_watch = False # stopped before an access to a watched address
+
+	def preloop(self):
+		self.where()
+
+	def emptyline(self):
+		pass # don't repeat the last command
+
+	def default(self, line):
+		print('Unknown command %r, try help' % line.split()[0])
+
+	def address(self, arg):
+		'''parses an address: a number, or LABEL[+OFFSET] given debug info'''
+		m = re.match('(0x[0-9a-f]+|\d+)$', arg, re.I)
+		if m:
+			return int(arg, 0)
+		m = re.match('([\w.]+)(?:\+(0x[0-9a-f]+|\d+))?$', arg, re.I)
+		addr = self.debug.address(m.group(1)) if m and self.debug else None
+		if addr is None:
+			raise SimError('Unknown address %r' % arg)
+		return addr + int(m.group(2) or '0', 0)
+
+	def where(self):
+		'''prints the command at pc, or why the program stopped'''
+		sim = self.sim
+		if sim.halted:
+			print('Program exited with code %d after %d commands'
+				% (sim.exit_code, sim.steps))
+			return
+		if sim.stopped:
+			print(sim.stopped)
+		self.show(sim.pc, marker='=>')
+
+	def show(self, addr, marker=''):
+		sim = self.sim
+		i = (addr - sim.text_start) >> 2
+		if not 0 <= i < len(sim.text):
+			print('%-2s 0x%08x' % (marker, addr))
+			return
+		source = ''
+		if self.debug:
+			source = symbol_name(addr, self.debug)
+			line = self.debug.line(addr)
+			if line:
+				source += ' (%s:%d)' % line
+		print(('%-2s 0x%08x  %-30s %s' % (marker, addr, sim.disassemble(i),
+										source)).rstrip())
+
+	def resume(self, run):
+		'''steps over a watched access we stopped at, then calls run()'''
+		sim = self.sim
+		try:
+			if self.at_watch:
+				sim.mem.watching = False
+				try:
+					sim.step()
+				finally:
+					sim.mem.watching = True
+			self.at_watch = False
+			run()
+		except WatchHit as ex:
+			sim.stopped = '%s at 0x%08x' % (ex, sim.pc)
+		except SimError as ex:
+			print('Error: %s' % ex)
+			return
+		self.at_watch = bool(sim.stopped and sim.stopped.startswith('Watchpoint'))
+		self.where()
+
+	def do_break(self, arg):
+		'''break ADDR|LABEL: stop before the command at an address'''
+		try:
+			addr = self.address(arg)
+		except SimError as ex:
+			print(ex)
+			return
+		self.sim.set_breakpoint(addr)
+		print('Breakpoint at 0x%08x' % addr)
+
+	def do_delete(self, arg):
+		'''delete [ADDR|LABEL]: remove a breakpoint, or all of them'''
+		try:
+			addrs = [self.address(arg)] if arg else list(self.sim.breakpoints)
+		except SimError as ex:
+			print(ex)
+			return
+		for addr in addrs:
+			self.sim.set_breakpoint(addr, False)
+
+	def do_watch(self, arg):
+		'''watch ADDR[:LAST] [rw]: stop before writes (rw: and reads) of memory'''
+		args = arg.split()
+		if not args:
+			for first, last, reads in self.sim.mem.watches:
+				print('0x%08x:0x%08x %s' % (first, last, 'rw' if reads else 'w'))
+			return
+		try:
+			bounds = [self.address(x) for x in args[0].split(':')]
+		except SimError as ex:
+			print(ex)
+			return
+		self.sim.mem.watch(bounds[0], bounds[-1], args[1:] == ['rw'])
+
+	def do_unwatch(self, arg):
+		'''unwatch: remove all watchpoints'''
+		self.sim.mem.unwatch()
+
+	def do_step(self, arg):
+		'''step [N]: execute N commands (default 1)'''
+		n = (int(arg) if arg.isdigit() else 1) - self.at_watch
+		def run():
+			self.sim.stopped = None
+			for k in range(n):
+				if self.sim.halted:
+					break
+				self.sim.step()
+		self.resume(run)
+
+	def do_continue(self, arg):
+		'''continue: run until a breakpoint, watchpoint, error or exit'''
+		self.resume(self.sim.run)
+
+	def do_regs(self, arg):
+		'''regs: show the general purpose registers, HI, LO and PC'''
+		print_regs(self.sim)
+
+	def do_print(self, arg):
+		'''print REG: show a register ($t0, $8, $f2, hi, lo or pc)'''
+		sim = self.sim
+		arg = arg.strip()
+		if arg in ('hi', 'lo', 'pc'):
+			value = getattr(sim, arg)
+		elif re.match('\$f([0-9]|[12][0-9]|3[01])$', arg):
+			value = sim.fregs[int(arg[2:])]
+		else:
+			try:
+				value = sim.regs[mipster.reg_num(arg)]
+			except mipster.ASMError as ex:
+				print(ex)
+				return
+		print('%s = 0x%08x (%d)' % (arg, value, s32(value)))
+
+	def do_mem(self, arg):
+		'''mem ADDR [WORDS]: show memory words (default 4)'''
+		args = arg.split()
+		try:
+			addr = self.address(args[0]) & ~3 if args else self.sim.regs[29]
+		except SimError as ex:
+			print(ex)
+			return
+		n = int(args[1]) if len(args) > 1 else 4
+		mem = self.sim.mem
+		mem.watching = False # looking doesn't trigger watchpoints
+		try:
+			for a in range(addr, addr + 4*n, 16):
+				print('0x%08x  %s' % (a, ' '.join('%08x' % mem.load_word(a + 4*k)
+					for k in range(min(4, (addr + 4*n - a) // 4)))))
+		finally:
+			mem.watching = True
+
+	def do_list(self, arg):
+		'''list [ADDR|LABEL]: disassemble around an address (default: pc)'''
+		try:
+			addr = self.address(arg) if arg else self.sim.pc
+		except SimError as ex:
+			print(ex)
+			return
+		for a in range(max(self.sim.text_start, addr - 16), addr + 20, 4):
+			if a >= self.sim.text_end:
+				break
+			self.show(a, '=>' if a == self.sim.pc else
+					'*' if a in self.sim.breakpoints else '')
+
+	def do_quit(self, arg):
+		'''quit: stop debugging'''
+		return True
+
+	do_b = do_break
+	do_c = do_continue
+	do_s = do_step
+	do_l = do_list
+	do_p = do_print
+	do_q = do_quit
+	do_EOF = do_quit
+
+class Tracer(object):
+	'''
+	records each executed command as five 32-bit words (pc, instruction
+	word, destination register, the value written to it, memory address)
+	in a preallocated array, by hooking every command handler. The array is
+	written out whenever it fills or, when keeping only the last records,
+	used as a ring buffer and written out by close()
+	'''
+	def __init__(self, sim, f, last=0, records=1 << 16):
+		self.sim = sim
+		self.f = f
+		self.ring = bool(last)
+		self.size = trace_fields * (last or records)
+		self.buf = array.array('I', [0]) * self.size
+		self.pos = 0
+		self.wrapped = False
+		self.dests = array.array('l', [-1]) * len(sim.text) # -1 = not yet known
+		f.write(trace_header.pack(trace_magic, sim.text_start))
+		sim.hook(list(sim.ops), self.wrap)
+
+	def wrap(self, name, op):
+		start = self.sim.text_start
+		text = self.sim.text
+		dests = self.dests
+		memory = name in mipster.load_cmds or name in mipster.store_cmds
+		syscall = name == 'syscall'
+		def traced(sim, c):
+			addr = (sim.regs[c[1]] + c[6]) & mask32 if memory else no_value
+			if syscall: # the destination depends on $v0 before the call
+				d = syscall_dests.get(sim.regs[2], no_value)
+			t = op(sim, c)
+			i = (c[8] - start) >> 2
+			if not syscall:
+				d = dests[i]
+				if d < 0:
+					d = dests[i] = self.destination(i)
+			if d == no_value:
+				value = 0
+			elif d < 32:
+				value = sim.regs[d]
+			elif d < 64:
+				value = sim.fregs[d - 32]
+			else:
+				value = sim.hi if d == hi_reg else sim.lo
+			buf = self.buf
+			k = self.pos
+			buf[k] = c[8]
+			buf[k+1] = text[i]
+			buf[k+2] = d
+			buf[k+3] = value
+			buf[k+4] = addr
+			k += trace_fields
+			if k == self.size:
+				k = 0
+				if self.ring:
+					self.wrapped = True
+				else:
+					self.write(buf)
+			self.pos = k
+			return t
+		return traced
+
+	def destination(self, i):
+		'''returns the register text word i writes, numbered as in trace records'''
+		try:
+			defs = mipster.get_defs_uses(self.sim.disassemble(i), self.sim.isa)[0]
+		except mipster.ASMError:
+			return no_value
+		for r in sorted(defs, key=str):
+			if isinstance(r, int):
+				return r
+			if r.startswith('f') and r[1:].isdigit():
+				return 32 + int(r[1:])
+		if 'lo' in defs:
+			return lo_reg
+		return no_value
+
+	def write(self, buf):
+		if sys.byteorder != 'little':
+			buf = array.array('I', buf)
+			buf.byteswap()
+		self.f.write(buf)
+
+	def close(self):
+		'''writes out the buffered records, oldest first, and closes the file'''
+		if self.wrapped:
+			self.write(self.buf[self.pos:])
+		self.write(self.buf[:self.pos])
+		self.f.close()
+
+def read_trace(filename):
+	'''
+	reads a trace file written by Tracer
+	returns:
+		(text start address, array of records' words, five per record)
+	'''
+	with open(filename, 'rb') as f:
+		data = f.read()
+	if data[:8] != trace_magic:
+		raise SimError('%s is not a simulator trace' % filename)
+	text_start = trace_header.unpack_from(data)[1]
+	words = array.array('I', data[trace_header.size:])
+	if sys.byteorder != 'little':
+		words.byteswap()
+	return (text_start, words)
+
+class Pipeline(object):
+	'''
+	times the executed commands on an in-order IF/ID/EX/MEM/WB pipeline with
+	forwarding into EX. A result can enter EX isa.latencies[name] cycles
+	(from the ISA file, 1 by default) after its producer did, so loads cost one
+	load-use interlock; branches and jr resolve in ID (whose operands must
+	be ready a cycle earlier) or EX, and a taken one refetches from its
+	target, after the delay slot if there is one. Jumps to known targets
+	resolve in ID. Each executed block is timed after it runs, from its
+	decoded commands
+	'''
+	def __init__(self, sim, resolve='ID', timeline=None, rows=100):
+		self.sim = sim
+		self.resolve = resolve
+		self.timeline = timeline # (lo, hi) addresses to record, or None
+		self.rows = rows
+		self.traced = [] # (pc, IF, ID, EX) cycles of recorded commands
+		self.info = [None] * len(sim.text) # word -> (defs, uses, latency, cause)
+		self.ready = {} # register -> first cycle it can be used in EX
+		self.producer = {} # register -> stall cause of waiting for it
+		self.last_decode = 0 # ID cycle of the last command
+		self.refetch = 0 # first IF cycle after the last taken branch or jump
+		self.ex = 1 # EX cycle of the last command
+		self.instrs = 0
+		self.stalls = collections.Counter() # cause -> cycles
+		sim.block_hooks.append(self.block)
+
+	def analyze(self, i):
+		'''returns (defs, uses, latency, stall cause) of text word i'''
+		name = self.sim.names[i]
+		try:
+			defs, uses = mipster.get_defs_uses(self.sim.disassemble(i), self.sim.isa)
+		except mipster.ASMError:
+			defs, uses = set(), set()
+		defs.discard('mem') # memory accesses stay in order in MEM
+		uses.discard('mem')
+		defs.discard(0)
+		if name in mipster.load_cmds:
+			cause = 'load-use'
+		elif name in mipster.hilo_cmds or name == 'mul':
+			cause = 'multiply/divide'
+		elif name is not None and '.' in name:
+			cause = 'floating point'
+		else:
+			cause = 'data'
+		self.info[i] = (tuple(defs), tuple(uses),
+						self.sim.isa.latencies.get(name, 1), cause)
+		return self.info[i]
+
+	def block(self, b, target):
+		info = self.info
+		ready = self.ready
+		producer = self.producer
+		stalls = self.stalls
+		names = self.sim.names
+		d = self.last_decode
+		ex = self.ex
+		for c in b[0]:
+			i = (c[8] - self.sim.text_start) >> 2
+			defs, uses, latency, cause = info[i] or self.analyze(i)
+			name = names[i]
+			f = max(d, self.refetch) # IF frees when the last command enters ID
+			d = max(f + 1, ex) # ID frees when the last command enters EX
+			t = d + 1
+			if t > ex + 1: # waiting for the target of a taken branch or jump
+				stalls['branch'] += t - ex - 1
+			need, why = t, None
+			for r in uses:
+				if ready.get(r, 0) > need:
+					need, why = ready[r], producer[r]
+			if need > t:
+				stalls[why] += need - t
+				t = need
+			in_id = self.resolve == 'ID' and (name in mipster.branch_cmds
+											or name in ('jr', 'jalr'))
+			if in_id and uses:
+				need = max(ready.get(r, 0) for r in uses) + 1
+				if need > t:
+					stalls['branch operand'] += need - t
+					t = need
+			if self.timeline and self.timeline[0] <= c[8] <= self.timeline[1] \
+					and len(self.traced) < self.rows:
+				self.traced.append((c[8], f, d, t))
+			ex = t
+			for r in defs:
+				ready[r] = t + latency
+				producer[r] = cause
+			if in_id or name in ('j', 'jal'):
+				resolved = t - 1
+			elif name in mipster.branch_cmds or name in mipster.jump_cmds:
+				resolved = t
+		if target is not None:
+			self.refetch = resolved + 1 # after the delay slot, if any
+		self.instrs += len(b[0])
+		self.last_decode = d
+		self.ex = ex
+
+	def cycles(self):
+		'''returns the cycles up to the last command's WB'''
+		return self.ex + 3 if self.instrs else 0
+
+	def print_stats(self):
+		'''prints the CPI and the stall cycles by cause'''
+		cycles = self.cycles()
+		print('pipeline: %d commands, %d cycles, CPI %.3f (branches resolve in %s)'
+			% (self.instrs, cycles, float(cycles) / (self.instrs or 1), self.resolve))
+		for cause, n in self.stalls.most_common():
+			print('%12d  %5.2f%%  %s stalls' % (n, 100.0 * n / (cycles or 1), cause))
+
+	def print_timeline(self):
+		'''prints the cycle of each stage of the recorded commands'''
+		if not self.traced:
+			return
+		first = self.traced[0][1]
+		for pc, f, d, ex in self.traced:
+			stages = ['  '] * (f - first) + ['--'] * (ex - f) # -- = stalled
+			stages[f - first] = 'IF'
+			stages[d - first] = 'ID'
+			stages += ['EX', 'ME', 'WB']
+			print('%08x  %-28s %s' % (pc, self.sim.disassemble(
+				(pc - self.sim.text_start) >> 2), ' '.join(stages)))
+
+def make_decoder(isa):
+	'''
+	builds a table matching instruction words to the real commands of an ISA
+	returns:
+		dict of major opcode (or None, for encodings that don't fix it) to
+		lists of (mask, fixed bits, command name, syntax), most specific first
+	'''
+	table = collections.defaultdict(list)
+	for key, spec in isa.specs.items():
+		major = spec.opcode >> 26 if spec.mask >> 26 == 0x3f else None
+		table[major].append((spec.mask, spec.opcode, spec.name, key))
+	for cmds in table.values():
+		cmds.sort(key=lambda x: -bin(x[0]).count('1')) # stable: keeps file order
+	return dict(table)
+
+def decode(decoder, w):
+	'''returns (command name, syntax) of instruction word w, or None'''
+	for mask, opcode, name, key in decoder.get(w >> 26, []) + decoder.get(None, []):
+		if w & mask == opcode:
+			return (name, key)
+	return None
+
+def disassemble(isa, decoder, w, pc):
+	'''returns the assembly text of instruction word w at address pc'''
+	d = decode(decoder, w)
+	if d is None:
+		return '.word 0x%08x' % w
+	name, key = d
+	vals = []
+	for i, kind, runs in isa.specs[key].fields:
+		shift, width = runs[0]
+		v = (w >> shift) & ((1 << width) - 1)
+		if kind == 'gpr':
+			vals.append(mipster.regs[v])
+		elif kind == 'fpr':
+			vals.append('$f%d' % v)
+		elif kind == 'size':
+			vals.append(str(v + 1))
+		elif kind == 'msb':
+			vals.append(str(v - int(vals[-1]) + 1))
+		elif name in mipster.branch_cmds and width == 16:
+			vals.append('0x%08x' % ((pc + 4 + (sign_extend(v, 16) << 2)) & mask32))
+		elif width == 26:
+			vals.append('0x%08x' % (((pc + 4) & 0xf0000000) | (v << 2)))
+		elif width == 16 and name not in ('andi', 'ori', 'xori', 'lui'):
+			vals.append(str(sign_extend(v, 16)))
+		else:
+			vals.append(str(v))
+	# substitute the values into the syntax, keeping its parentheses
+	tokens = re.split('([\s()]+)', key[len(name):].strip())
+	vals.reverse()
+	for k in range(0, len(tokens), 2):
+		if tokens[k]:
+			tokens[k] = vals.pop()
+		if k + 1 < len(tokens) and tokens[k+1] == ' ':
+			tokens[k+1] = ', '
+	return (name + ' ' + ''.join(tokens)).strip()
+
+def format_float(v, fmt):
+	'''
+	formats a float as Java (and so MARS) prints it: the shortest decimal
+	that reads back as the same single or double, with at least one digit
+	after the point
+	'''
+	if v != v:
+		return 'NaN'
+	if math.isinf(v):
+		return 'Infinity' if v > 0 else '-Infinity'
+	bits = fmt.pack(v)
+	for digits in range(1, 18):
+		if fmt.pack(float('%.*g' % (digits, v))) == bits:
+			break
+	if not v or 1e-3 <= abs(v) < 1e7:
+		return repr(float('%.*g' % (digits, v)))
+	mantissa, exp = ('%.*e' % (digits - 1, v)).split('e')
+	if '.' not in mantissa:
+		mantissa += '.0'
+	return '%sE%d' % (mantissa, int(exp))
+
+def symbol_name(addr, debug):
+	'''names an address by its label, or by the address itself'''
+	sym = debug.symbol(addr) if debug else None
+	if not sym:
+		return '0x%08x' % addr
+	return sym[0] if not sym[1] else '%s+0x%x' % sym
+
+def sign_extend(v, bits):
+	'''interprets the low bits of v as a two's complement number'''
+	return v - (1 << bits) if v & (1 << (bits - 1)) else v
+
+def s32(x):
+	'''interprets a 32-bit word as a signed int'''
+	return x - 0x100000000 if x & 0x80000000 else x
+
+# command handlers; each takes the simulator and a decoded command tuple
+# (handler, rs, rt, rd, sa, imm, simm, target, pc) and returns the address
+# to continue at if it transfers control
+
+def op_nop(sim, c):
+	pass
+
+def op_illegal(sim, c):
+	raise SimError('Illegal instruction')
+
+def op_unimplemented(sim, c):
+	i = (c[8] - sim.text_start) >> 2
+	raise SimError('Unimplemented command %r' % sim.names[i])
+
+def op_add(sim, c):
+	r = sim.regs
+	v = s32(r[c[1]]) + s32(r[c[2]])
+	if not -0x80000000 <= v <= 0x7fffffff:
+		raise SimError('Arithmetic overflow')
+	r[c[3]] = v & mask32
+
+def op_addu(sim, c):
+	r = sim.regs
+	r[c[3]] = (r[c[1]] + r[c[2]]) & mask32
+
+def op_sub(sim, c):
+	r = sim.regs
+	v = s32(r[c[1]]) - s32(r[c[2]])
+	if not -0x80000000 <= v <= 0x7fffffff:
+		raise SimError('Arithmetic overflow')
+	r[c[3]] = v & mask32
+
+def op_subu(sim, c):
+	r = sim.regs
+	r[c[3]] = (r[c[1]] - r[c[2]]) & mask32
+
+def op_and(sim, c):
+	r = sim.regs
+	r[c[3]] = r[c[1]] & r[c[2]]
+
+def op_or(sim, c):
+	r = sim.regs
+	r[c[3]] = r[c[1]] | r[c[2]]
+
+def op_xor(sim, c):
+	r = sim.regs
+	r[c[3]] = r[c[1]] ^ r[c[2]]
+
+def op_nor(sim, c):
+	r = sim.regs
+	r[c[3]] = ~(r[c[1]] | r[c[2]]) & mask32
+
+def op_slt(sim, c):
+	r = sim.regs
+	r[c[3]] = int(s32(r[c[1]]) < s32(r[c[2]]))
+
+def op_sltu(sim, c):
+	r = sim.regs
+	r[c[3]] = int(r[c[1]] < r[c[2]])
+
+def op_sll(sim, c):
+	r = sim.regs
+	r[c[3]] = (r[c[2]] << c[4]) & mask32
+
+def op_srl(sim, c):
+	r = sim.regs
+	r[c[3]] = r[c[2]] >> c[4]
+
+def op_sra(sim, c):
+	r = sim.regs
+	r[c[3]] = (s32(r[c[2]]) >> c[4]) & mask32
+
+def op_sllv(sim, c):
+	r = sim.regs
+	r[c[3]] = (r[c[2]] << (r[c[1]] & 31)) & mask32
+
+def op_srlv(sim, c):
+	r = sim.regs
+	r[c[3]] = r[c[2]] >> (r[c[1]] & 31)
+
+def op_srav(sim, c):
+	r = sim.regs
+	r[c[3]] = (s32(r[c[2]]) >> (r[c[1]] & 31)) & mask32
+
+def op_rotr(sim, c):
+	r = sim.regs
+	x = r[c[2]]
+	r[c[3]] = ((x >> c[4]) | (x << (32 - c[4]))) & mask32
+
+def op_rotrv(sim, c):
+	r = sim.regs
+	x = r[c[2]]
+	n = r[c[1]] & 31
+	r[c[3]] = ((x >> n) | (x << (32 - n))) & mask32
+
+def op_addi(sim, c):
+	r = sim.regs
+	v = s32(r[c[1]]) + c[6]
+	if not -0x80000000 <= v <= 0x7fffffff:
+		raise SimError('Arithmetic overflow')
+	if c[2]:
+		r[c[2]] = v & mask32
+
+def op_addiu(sim, c):
+	r = sim.regs
+	r[c[2]] = (r[c[1]] + c[6]) & mask32
+
+def op_andi(sim, c):
+	r = sim.regs
+	r[c[2]] = r[c[1]] & c[5]
+
+def op_ori(sim, c):
+	r = sim.regs
+	r[c[2]] = r[c[1]] | c[5]
+
+def op_xori(sim, c):
+	r = sim.regs
+	r[c[2]] = r[c[1]] ^ c[5]
+
+def op_slti(sim, c):
+	r = sim.regs
+	r[c[2]] = int(s32(r[c[1]]) < c[6])
+
+def op_sltiu(sim, c):
+	r = sim.regs
+	r[c[2]] = int(r[c[1]] < c[6] & mask32)
+
+def op_lui(sim, c):
+	sim.regs[c[2]] = c[5] << 16
+
+def op_mult(sim, c):
+	r = sim.regs
+	p = s32(r[c[1]]) * s32(r[c[2]])
+	sim.hi = (p >> 32) & mask32
+	sim.lo = p & mask32
+
+def op_multu(sim, c):
+	r = sim.regs
+	p = r[c[1]] * r[c[2]]
+	sim.hi = p >> 32
+	sim.lo = p & mask32
+
+def op_div(sim, c):
+	r = sim.regs
+	a, b = s32(r[c[1]]), s32(r[c[2]])
+	if b: # the result of dividing by zero is unpredictable; leave HI/LO alone
+		q = abs(a) // abs(b) * (-1 if (a < 0) != (b < 0) else 1)
+		sim.lo = q & mask32
+		sim.hi = (a - q * b) & mask32
+
+def op_divu(sim, c):
+	r = sim.regs
+	a, b = r[c[1]], r[c[2]]
+	if b:
+		sim.lo = a // b
+		sim.hi = a % b
+
+def op_madd(sim, c):
+	r = sim.regs
+	acc = s32(sim.hi) << 32 | sim.lo
+	acc += s32(r[c[1]]) * s32(r[c[2]])
+	sim.hi = (acc >> 32) & mask32
+	sim.lo = acc & mask32
+
+def op_maddu(sim, c):
+	r = sim.regs
+	acc = (sim.hi << 32 | sim.lo) + r[c[1]] * r[c[2]]
+	sim.hi = (acc >> 32) & mask32
+	sim.lo = acc & mask32
+
+def op_msub(sim, c):
+	r = sim.regs
+	acc = s32(sim.hi) << 32 | sim.lo
+	acc -= s32(r[c[1]]) * s32(r[c[2]])
+	sim.hi = (acc >> 32) & mask32
+	sim.lo = acc & mask32
+
+def op_msubu(sim, c):
+	r = sim.regs
+	acc = (sim.hi << 32 | sim.lo) - r[c[1]] * r[c[2]]
+	sim.hi = (acc >> 32) & mask32
+	sim.lo = acc & mask32
+
+def op_mul(sim, c):
+	r = sim.regs
+	r[c[3]] = (s32(r[c[1]]) * s32(r[c[2]])) & mask32
+
+def op_mfhi(sim, c):
+	sim.regs[c[3]] = sim.hi
+
+def op_mflo(sim, c):
+	sim.regs[c[3]] = sim.lo
+
+def op_mthi(sim, c):
+	sim.hi = sim.regs[c[1]]
+
+def op_mtlo(sim, c):
+	sim.lo = sim.regs[c[1]]
+
+def op_movn(sim, c):
+	r = sim.regs
+	if r[c[2]]:
+		r[c[3]] = r[c[1]]
+
+def op_movz(sim, c):
+	r = sim.regs
+	if not r[c[2]]:
+		r[c[3]] = r[c[1]]
+
+def op_seb(sim, c):
+	r = sim.regs
+	r[c[3]] = sign_extend(r[c[2]] & 0xff, 8) & mask32
+
+def op_seh(sim, c):
+	r = sim.regs
+	r[c[3]] = sign_extend(r[c[2]] & 0xffff, 16) & mask32
+
+def op_wsbh(sim, c):
+	r = sim.regs
+	x = r[c[2]]
+	r[c[3]] = ((x & 0x00ff00ff) << 8) | ((x >> 8) & 0x00ff00ff)
+
+def op_ext(sim, c): # lsb in sa, size - 1 in rd
+	r = sim.regs
+	r[c[2]] = (r[c[1]] >> c[4]) & ((1 << (c[3] + 1)) - 1)
+
+def op_ins(sim, c): # lsb in sa, msb in rd
+	r = sim.regs
+	m = ((1 << (c[3] - c[4] + 1)) - 1) << c[4]
+	r[c[2]] = (r[c[2]] & ~m | (r[c[1]] << c[4]) & m) & mask32
+
+def op_beq(sim, c):
+	r = sim.regs
+	if r[c[1]] == r[c[2]]:
+		return c[7]
+
+def op_bne(sim, c):
+	r = sim.regs
+	if r[c[1]] != r[c[2]]:
+		return c[7]
+
+def op_bgez(sim, c):
+	if not sim.regs[c[1]] & 0x80000000:
+		return c[7]
+
+def op_bgezal(sim, c):
+	r = sim.regs
+	taken = not r[c[1]] & 0x80000000
+	r[31] = c[8] + sim.link
+	if taken:
+		return c[7]
+
+def op_bgtz(sim, c):
+	x = sim.regs[c[1]]
+	if x and not x & 0x80000000:
+		return c[7]
+
+def op_blez(sim, c):
+	x = sim.regs[c[1]]
+	if not x or x & 0x80000000:
+		return c[7]
+
+def op_bltz(sim, c):
+	if sim.regs[c[1]] & 0x80000000:
+		return c[7]
+
+def op_bltzal(sim, c):
+	r = sim.regs
+	taken = r[c[1]] & 0x80000000
+	r[31] = c[8] + sim.link
+	if taken:
+		return c[7]
+
+def op_j(sim, c):
+	return c[7]
+
+def op_jal(sim, c):
+	sim.regs[31] = c[8] + sim.link
+	return c[7]
+
+def op_jr(sim, c):
+	return sim.regs[c[1]]
+
+def op_jalr(sim, c):
+	r = sim.regs
+	target = r[c[1]]
+	if c[3]:
+		r[c[3]] = c[8] + sim.link
+	return target
+
+def op_lb(sim, c):
+	r = sim.regs
+	r[c[2]] = sign_extend(sim.mem.load_byte((r[c[1]] + c[6]) & mask32), 8) & mask32
+
+def op_lbu(sim, c):
+	r = sim.regs
+	r[c[2]] = sim.mem.load_byte((r[c[1]] + c[6]) & mask32)
+
+def op_lh(sim, c):
+	r = sim.regs
+	r[c[2]] = sign_extend(sim.mem.load_half((r[c[1]] + c[6]) & mask32), 16) & mask32
+
+def op_lhu(sim, c):
+	r = sim.regs
+	r[c[2]] = sim.mem.load_half((r[c[1]] + c[6]) & mask32)
+
+def op_lw(sim, c):
+	r = sim.regs
+	r[c[2]] = sim.mem.load_word((r[c[1]] + c[6]) & mask32)
+
+def op_sb(sim, c):
+	r = sim.regs
+	sim.mem.store_byte((r[c[1]] + c[6]) & mask32, r[c[2]])
+
+def op_sh(sim, c):
+	r = sim.regs
+	sim.mem.store_half((r[c[1]] + c[6]) & mask32, r[c[2]])
+
+def op_sw(sim, c):
+	r = sim.regs
+	sim.mem.store_word((r[c[1]] + c[6]) & mask32, r[c[2]])
+
+def op_syscall(sim, c):
+	sim.io.syscall(sim)
+
+# floating point registers hold raw bits; doubles use an even/odd pair with
+# the low word in the even register, as in MARS
+
+def get_s(sim, n):
+	return single.unpack(word.pack(sim.fregs[n]))[0]
+
+def put_s(sim, n, v):
+	try:
+		sim.fregs[n] = word.unpack(single.pack(v))[0]
+	except OverflowError: # too large for single precision
+		sim.fregs[n] = word.unpack(single.pack(math.copysign(float('inf'), v)))[0]
+
+def get_d(sim, n):
+	f = sim.fregs
+	return double.unpack(dword.pack(f[n & ~1] | f[n | 1] << 32))[0]
+
+def put_d(sim, n, v):
+	bits = dword.unpack(double.pack(v))[0]
+	sim.fregs[n & ~1] = bits & mask32
+	sim.fregs[n | 1] = bits >> 32
+
+def fdiv(a, b):
+	'''IEEE division, giving infinities and NaNs instead of raising'''
+	if b:
+		return a / b
+	if a != a or not a:
+		return float('nan')
+	return math.copysign(float('inf'), a) * math.copysign(1.0, b)
+
+def fsqrt(a):
+	return math.sqrt(a) if a >= 0 else float('nan')
+
+def to_word(v, rounding):
+	'''converts a float to a 32-bit int, saturating invalid results as MIPS does'''
+	if v != v or math.isinf(v):
+		return 0x7fffffff
+	v = int(rounding(v))
+	return v & mask32 if -0x80000000 <= v <= 0x7fffffff else 0x7fffffff
+
+def fp_binary(get, put, fn):
+	'''makes a handler computing fd = fn(fs, ft)'''
+	def op(sim, c):
+		put(sim, c[4], fn(get(sim, c[3]), get(sim, c[2])))
+	return op
+
+def fp_unary(get, put, fn):
+	'''makes a handler computing fd = fn(fs)'''
+	def op(sim, c):
+		put(sim, c[4], fn(get(sim, c[3])))
+	return op
+
+def fp_compare(get, fn):
+	'''makes a handler setting condition code cc to fn(fs, ft)'''
+	def op(sim, c):
+		sim.fcc[c[4] >> 2] = bool(fn(get(sim, c[3]), get(sim, c[2])))
+	return op
+
+def fp_move(pair, cond=None):
+	'''makes a handler copying fs to fd, if cond(rt) holds'''
+	def op(sim, c):
+		if cond is None or cond(sim.regs[c[2]]):
+			f = sim.fregs
+			f[c[4]] = f[c[3]]
+			if pair:
+				f[c[4] | 1] = f[c[3] | 1]
+	return op
+
+def fp_sign(pair, fn):
+	'''makes a handler applying fn to the sign word of fs, storing it in fd'''
+	def op(sim, c):
+		f = sim.fregs
+		if pair:
+			f[c[4] & ~1] = f[c[3] & ~1]
+			f[c[4] | 1] = fn(f[c[3] | 1])
+		else:
+			f[c[4]] = fn(f[c[3]])
+	return op
+
+def get_w(sim, n):
+	return s32(sim.fregs[n])
+
+def put_w(sim, n, v):
+	sim.fregs[n] = v
+
+def op_bc1t(sim, c):
+	if sim.fcc[c[2] >> 2]:
+		return c[7]
+
+def op_bc1f(sim, c):
+	if not sim.fcc[c[2] >> 2]:
+		return c[7]
+
+def op_mfc1(sim, c):
+	sim.regs[c[2]] = sim.fregs[c[3]]
+
+def op_mtc1(sim, c):
+	sim.fregs[c[3]] = sim.regs[c[2]]
+
+def op_lwc1(sim, c):
+	sim.fregs[c[2]] = sim.mem.load_word((sim.regs[c[1]] + c[6]) & mask32)
+
+def op_swc1(sim, c):
+	sim.mem.store_word((sim.regs[c[1]] + c[6]) & mask32, sim.fregs[c[2]])
+
+def op_ldc1(sim, c):
+	addr = (sim.regs[c[1]] + c[6]) & mask32
+	sim.fregs[c[2] & ~1] = sim.mem.load_word(addr)
+	sim.fregs[c[2] | 1] = sim.mem.load_word((addr + 4) & mask32)
+
+def op_sdc1(sim, c):
+	addr = (sim.regs[c[1]] + c[6]) & mask32
+	sim.mem.store_word(addr, sim.fregs[c[2] & ~1])
+	sim.mem.store_word((addr + 4) & mask32, sim.fregs[c[2] | 1])
+
+# command name -> handler
+ops = dict((name[3:], f) for name, f in list(globals().items())
+		if name.startswith('op_') and name not in ('op_nop', 'op_illegal',
+												'op_unimplemented'))
+ops['nop'] = op_nop
+for fmt, get, put in (('s', get_s, put_s), ('d', get_d, put_d)):
+	ops['add.' + fmt] = fp_binary(get, put, lambda a, b: a + b)
+	ops['sub.' + fmt] = fp_binary(get, put, lambda a, b: a - b)
+	ops['mul.' + fmt] = fp_binary(get, put, lambda a, b: a * b)
+	ops['div.' + fmt] = fp_binary(get, put, fdiv)
+	ops['sqrt.' + fmt] = fp_unary(get, put, fsqrt)
+	ops['mov.' + fmt] = fp_move(fmt == 'd')
+	ops['movn.' + fmt] = fp_move(fmt == 'd', lambda x: x != 0)
+	ops['movz.' + fmt] = fp_move(fmt == 'd', lambda x: x == 0)
+	ops['neg.' + fmt] = fp_sign(fmt == 'd', lambda x: x ^ 0x80000000)
+	ops['abs.' + fmt] = fp_sign(fmt == 'd', lambda x: x & 0x7fffffff)
+	ops['c.eq.' + fmt] = fp_compare(get, lambda a, b: a == b)
+	ops['c.lt.' + fmt] = fp_compare(get, lambda a, b: a < b)
+	ops['c.le.' + fmt] = fp_compare(get, lambda a, b: a <= b)
+	ops['cvt.w.' + fmt] = fp_unary(get, put_w, lambda v: to_word(v, round))
+	ops['round.w.' + fmt] = fp_unary(get, put_w, lambda v: to_word(v, round))
+	ops['trunc.w.' + fmt] = fp_unary(get, put_w, lambda v: to_word(v, int))
+ops['cvt.s.d'] = fp_unary(get_d, put_s, float)
+ops['cvt.s.w'] = fp_unary(get_w, put_s, float)
+ops['cvt.d.s'] = fp_unary(get_s, put_d, float)
+ops['cvt.d.w'] = fp_unary(get_w, put_d, float)
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -10,7 +10,13 @@ import os.path
 import io
 import re
 import collections
-import tempfile
+import concurrent.futures
+import time
+import array
+import sys
+import struct
+import mmap
+import bisect
 
 text_start_addr = 0x00400000 # starting address for the .text segment
 data_start_addr = 0x00001001 # starting address for the .data segment
@@ -18,8 +24,20 @@ data_start_addr = 0x00001001 # starting address for the .data segment
 data_seg = []
 data_labels = [] # holds each label in the .data segment of ASM file, indexed by line number
 text_labels = [] # holds each label in the .text segment of ASM file, indexed by line number
-
-listeq = lambda x, y: collections.Counter(x) == collections.Counter(y)
+text_symbols = {} # label -> .text command index, frozen after get_labels()
+local_labels = {} # numeric local label -> sorted .text command indices
+data_symbols = {} # label -> .data word index, frozen after get_labels()
+encoding_memo = collections.OrderedDict() # resolved command tuple -> binary string
+memo_size = 4096 # maximum number of entries in encoding_memo
+memo_stats = collections.Counter() # encoding_memo hits and misses
+profile = collections.OrderedDict() # assembler stage -> seconds
+debug = False # print debug information, set by -D
+constants = {} # .eqv/.set name -> expression tree, with earlier constants inlined
+expr_cache = {} # operand expression text -> expression tree, see parse_expr()
+expr_operands = {} # placeholder operand -> expression tree folded after layout
+expr_names = {} # expression tree -> placeholder operand
+expr_texts = {} # placeholder operand -> its source text, for listings
+expr_values = {} # placeholder operand -> value, cleared by freeze_labels()
 
 regs = (
 	'$zero','$at','$v0','$v1','$a0','$a1','$a2','$a3',
@@ -28,14 +46,86 @@ regs = (
 	'$t8','$t9','$k0','$k1','$gp','$sp','$fp','$ra'
 )
 
+branch_cmds = ('beq','bne','bgez','bgezal','bgtz','blez','bltz','bltzal',
+	'bc1t','bc1f')
+jump_cmds = ('j','jal','jr','jalr')
+link_cmds = ('jal','bgezal','bltzal','jalr') # commands that write the return address
+store_cmds = ('sb','sh','sw','swc1','sdc1')
+load_cmds = ('lb','lbu','lh','lhu','lw','lwc1','ldc1')
+hilo_cmds = ('mult','multu','div','divu','madd','maddu','msub','msubu')
+acc_cmds = ('madd','maddu','msub','msubu') # commands that also read HI/LO
+merge_cmds = ('movn','movz','ins') # commands that may keep the old destination
+
+# operand syntax -> (encoding letter, kind) fields understood by every ISA file
+default_fields = {'$s': ('s', 'gpr'), '$t': ('t', 'gpr'), '$d': ('d', 'gpr'),
+				'i': ('i', 'imm')}
+field_kinds = ('gpr', 'fpr', 'imm', 'size', 'msb', 'fmt')
+
+# memory image format -> file extension
+image_formats = collections.OrderedDict((('hex', '.hex'), ('coe', '.coe'),
+	('mif', '.mif'), ('memh', '.memh'), ('memb', '.memb')))
+
+hex2bin = str.maketrans(dict(('%x' % i, '{:04b}'.format(i)) for i in range(16)))
+
+# a basic ASM line, the source line it came from, and the syntax of the
+# pseudo-instruction it was expanded from (None for real commands)
+Stmt = collections.namedtuple('Stmt', 'text lineno source pseudo')
+
+# operand expression tokens: number, %hi/%lo, name, operator
+expr_token = re.compile('\s*(?:(0[xX][0-9a-fA-F]+|0[bB][01]+|\d+)|(%hi|%lo)|([A-Za-z_]\w*)|(<<|>>|[-+*/%&|^~()]))')
+# binary operators from loosest to tightest binding, as in C
+expr_levels = (('|',), ('^',), ('&',), ('<<', '>>'), ('+', '-'), ('*', '/', '%'))
+expr_ops = {
+	'|': lambda a, b: a | b, '^': lambda a, b: a ^ b, '&': lambda a, b: a & b,
+	'<<': lambda a, b: a << b, '>>': lambda a, b: a >> b,
+	'+': lambda a, b: a + b, '-': lambda a, b: a - b, '*': lambda a, b: a * b,
+	'/': lambda a, b: abs(a) // abs(b) * (-1 if (a < 0) != (b < 0) else 1),
+	'%': lambda a, b: a - b * expr_ops['/'](a, b),
+}
+# operands that never need expand_exprs(): registers, decimal numbers and
+# bare or local labels, each optionally followed by a base register
+simple_operand = '(?:\$\w+|\d+[bf]\b|-?\d+|[A-Za-z_]\w*)(?:\s*\(\s*\$\w+\s*\))?'
+simple_operands = re.compile('\s*(?:%s(?:(?:\s*,\s*|\s+)%s)*)?\s*$'
+							% (simple_operand, simple_operand))
+
+# debug sidecar header: magic, .text start and end addresses, number of line
+# table rows, number of symbols and string table size
+debug_magic = b'MIPSDBG1'
+debug_header = struct.Struct('<8sIIIII')
+
+# relocation file header: magic, .text and .data base addresses, number of
+# relocations; each relocation is a command index << 3 | an index into
+# reloc_kinds, naming the segment the word depends on and the field to patch
+reloc_magic = b'MIPSREL1'
+reloc_header = struct.Struct('<8sIII')
+reloc_kinds = ('text j26', 'text hi16', 'text lo16', 'data hi16', 'data lo16')
+
+IsaSpec = collections.namedtuple('IsaSpec', 'name opcode mask fields')
+
 class ASMError(Exception):
 	def __init__(self, value):
 		self.value = value
 	def __str__(self):
 		return str(self.value)
 
+class ISA(dict):
+	'''
+	maps command syntax (e.g. 'add $d $s $t') to its binary encoding pattern or
+	pseudo-instruction expansion, along with tables compiled when it is read:
+		index = (command name, operand format...) -> syntax, for find_cmd()
+		specs = syntax -> IsaSpec of each real command, for encoding
+		fields = operand syntax -> (encoding letter, kind)
+		latencies = command name -> cycles until its result can be used
+	'''
+	def __init__(self):
+		dict.__init__(self)
+		self.index = {}
+		self.specs = {}
+		self.fields = dict(default_fields)
+		self.latencies = {}
+
 def main():
-	global debug
+	global debug, memo_size
 	parser = argparse.ArgumentParser(description=__doc__)
 	parser.add_argument('-v', '--version', action='version',
 						version='%(prog)s 0.3')
@@ -51,33 +141,92 @@ def main():
 						metavar='HEX',
 						help='name of the data segment output file',
 						type=argparse.FileType('w'))
-#	parser.add_argument('-c', metavar='MARS',
-#						help='compare output to MARS hex file',
-#						type=argparse.FileType('r'))
+	parser.add_argument('-f', '--format', choices=image_formats, default='hex',
+						help='memory image format of the output files (default: %(default)s)')
+	parser.add_argument('--depth', metavar='WORDS', type=int,
+						help='pad memory images to WORDS memory words')
+	parser.add_argument('--width', metavar='BITS', type=int, default=32,
+						help='memory word width, a multiple or divisor of 32 (default: %(default)s)')
+	parser.add_argument('--addr-radix', type=int, choices=(2, 8, 10, 16),
+						default=16, help='MIF address radix (default: %(default)s)')
+	parser.add_argument('--data-radix', type=int, choices=(2, 10, 16),
+						default=16, help='COE/MIF data radix (default: %(default)s)')
+	parser.add_argument('--fill', metavar='WORD', type=lambda x: int(x, 0),
+						default=0, help='value of padding words (default: %(default)s)')
+	parser.add_argument('-l', '--listing', metavar='LST',
+						help='write an assembly listing with a symbol table')
+	parser.add_argument('-g', '--debug-info', metavar='DBG',
+						help='write a binary address to line and symbol map')
+	parser.add_argument('-R', '--relocs', metavar='REL',
+						help='write the relocations needed to rebase the text image')
+	parser.add_argument('--isa', metavar='FILE', default='mips_isa.txt',
+						help='ISA description file (default: %(default)s)')
+	parser.add_argument('--delay-slots', action='store_true',
+						help='fill branch delay slots with independent instructions')
+	parser.add_argument('--schedule', action='store_true',
+						help='reorder basic blocks to hide load-use and HI/LO latencies')
+	parser.add_argument('--timing', action='store_true',
+						help='report estimated cycles per basic block and label')
+	parser.add_argument('--latency', metavar='CMD=CYCLES', action='append',
+						help='override the result latency of a command',
+						type=latency_arg, default=[])
+	parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+						help='encode using N worker processes (0 = all cores)')
+	parser.add_argument('--memo-size', metavar='N', type=int, default=memo_size,
+						help='number of encoded commands to memoize (0 = off)')
+	parser.add_argument('-p', '--profile', action='store_true',
+						help='print time spent per stage and memo hit rates')
+	parser.add_argument('--branch-penalty', metavar='CYCLES', type=int,
+						default=1, help='cycles lost on each branch or jump')
+	parser.add_argument('-c', '--compare', metavar='MARS',
+						help='compare the text image to a MARS hex dump')
+	parser.add_argument('--compare-data', metavar='MARS',
+						help='compare the data image to a MARS hex dump')
+	parser.add_argument('--max-diffs', metavar='N', type=int, default=20,
+						help='mismatching words to show per image (default: %(default)s)')
 	args = parser.parse_args()
 	debug = args.Debug
-	isa = get_mips_isa() # make a dictionary of ISA commands and their encodings
+	memo_size = args.memo_size
+	t = time.perf_counter()
+	try:
+		isa = get_mips_isa(args.isa) # make a dictionary of ISA commands and their encodings
+	except (ASMError, IOError) as ex:
+		print(ex)
+		return
+	isa.latencies.update(args.latency)
+	t = lap('read ISA', t)
 
 	# form the output file if not supplied
 	if not args.out:
-		args.out = open(os.path.splitext(args.asm.name)[0] + '_txt.hex', 'w')
+		args.out = open(os.path.splitext(args.asm.name)[0] + '_txt'
+						+ image_formats[args.format], 'w')
 	
 	if not args.data:
-		args.data = open(os.path.splitext(args.asm.name)[0] + '_dat.hex', 'w')
+		args.data = open(os.path.splitext(args.asm.name)[0] + '_dat'
+						+ image_formats[args.format], 'w')
 
-	#tmp = tempfile.NamedTemporaryFile('r+', delete=False)
-	tmp = open(os.path.splitext(args.asm.name)[0] + '.tmp', 'w+')
-	
 	try:
-		asm2basic(args.asm, tmp, isa)
-		tmp.seek(0)
-		get_labels(tmp)
+		stmts = asm2basic(args.asm, isa)
+		t = lap('expand pseudo-instructions', t)
+		if args.schedule or args.delay_slots:
+			if args.schedule:
+				stmts, before, after = schedule_blocks(stmts, isa)
+				print('Estimated stalls: %d before scheduling, %d after'
+					% (before, after))
+			if args.delay_slots:
+				stmts, filled, slots = fill_delay_slots(stmts, isa)
+				print('Filled %d of %d branch delay slots' % (filled, slots))
+			t = lap('schedule', t)
+		get_labels(x.text for x in stmts)
+		freeze_labels()
+		t = lap('lay out labels', t)
+		if args.timing:
+			print_timing(get_timing(stmts, isa, args.branch_penalty))
+			t = lap('estimate timing', t)
 	except Exception as ex:
 		args.asm.close()
 		args.out.close()
 		args.data.close()
-		tmp.close()
-		#os.remove(tmp.name)
 		os.remove(args.out.name)
 		os.remove(args.data.name)
 		if isinstance(ex, ASMError):
@@ -86,61 +235,110 @@ def main():
 		else:
 			raise
 	
-	tmp.seek(0)
-
 	# create hex output
-	j = 0 # ASM command index/line number
-	data = False
-	for i, line in enumerate(tmp):
-		line = line.strip()
-		if re.match('\.data', line):
-			data = True
-		if re.match('\.text', line):
-			data = False
-		# skip comments, blank lines, lone labels, and headers
-		if re.match('(?:#.*)?$', line) \
-			or re.match('\w+:\s*(?:#.*)?$', line) \
-			or re.match('\.\w+', line) \
-			or data:
-			continue
-		print('i=%d j=%d '%(i,j) + '-'*70) if debug else None
-		try:
-			binstr = get_encoding(line, j, isa)
-		except Exception as ex:
-			args.asm.close()
-			args.out.close()
-			args.data.close()
-			tmp.close()
-			#os.remove(tmp.name)
-			os.remove(args.out.name)
-			os.remove(args.data.name)
-			if isinstance(ex, ASMError):
-				print(ex)
-				return
-			else:
-				raise
-		if binstr:
-			hexstr = binstr2hexstr(binstr)
-			print('%s -> %s' % (hexstr, binstr)) if debug else None
-			args.out.write(hexstr + '\n')
-		j += 1
-	
-	for n in data_seg:
-		args.data.write(int2hexstr(int(n)) + '\n')
+	try:
+		stmts = [stmts[i] for i, l in text_stmts([x.text for x in stmts])]
+		hexstrs = encode_text([x.text for x in stmts], isa, args.jobs)
+		t = lap('encode', t)
+		if args.listing:
+			with open(args.listing, 'w') as f:
+				write_listing(f, stmts, hexstrs)
+			t = lap('write listing', t)
+		if args.debug_info:
+			with open(args.debug_info, 'wb') as f:
+				write_debug_info(f, stmts, args.asm.name)
+			t = lap('write debug info', t)
+		if args.relocs:
+			with open(args.relocs, 'wb') as f:
+				write_relocs(f, [x.text for x in stmts])
+			t = lap('write relocations', t)
+		image = dict(fmt=args.format, depth=args.depth, width=args.width,
+					addr_radix=args.addr_radix, data_radix=args.data_radix,
+					fill=args.fill)
+		if args.format == 'hex' and args.width == 32 and not args.depth:
+			args.out.write(''.join(x + '\n' for x in hexstrs))
+		else:
+			write_image(args.out, [int(x, 16) for x in hexstrs], **image)
+		write_image(args.data, [int(n) for n in data_seg], **image)
+	except Exception as ex:
+		args.asm.close()
+		args.out.close()
+		args.data.close()
+		os.remove(args.out.name)
+		os.remove(args.data.name)
+		if isinstance(ex, ASMError):
+			print(ex)
+			return
+		else:
+			raise
 	
 	args.asm.close()
 	args.out.close()
-	tmp.close()
-	os.remove(tmp.name)
+	args.data.close()
+	t = lap('write output', t)
+	diffs = 0
+	if args.compare or args.compare_data:
+		try:
+			if args.compare:
+				diffs += compare_text(hexstrs, stmts, isa, args.compare, args.max_diffs)
+			if args.compare_data:
+				diffs += compare_data(args.compare_data, args.max_diffs)
+		except (ASMError, IOError) as ex:
+			print(ex)
+			diffs += 1
+		t = lap('compare', t)
 	print('data_seg = %r' % data_seg) if debug else None
+	print_profile() if args.profile else None
+	if diffs:
+		return 1
 	print('Assembler successful!')
 
-def asm2basic(infile, outfile, isa):
+def lap(stage, start):
+	'''adds the time since start to the profile of stage, returning the time now'''
+	now = time.perf_counter()
+	profile[stage] = profile.get(stage, 0) + now - start
+	return now
+
+def print_profile():
+	'''prints the time spent in each assembler stage and the memo hit rate'''
+	for stage, secs in profile.items():
+		print('%-28s %9.3f s' % (stage, secs))
+	total = memo_stats['hits'] + memo_stats['misses']
+	print('encoding memo: %d hits, %d misses (%.1f%% hit rate, %d entry limit)'
+		% (memo_stats['hits'], memo_stats['misses'],
+		100.0 * memo_stats['hits'] / total if total else 0, memo_size))
+
+def latency_arg(arg):
+	'''argparse type for CMD=CYCLES latency overrides'''
+	m = re.match('(\w+)=(\d+)$', arg)
+	if not m:
+		raise argparse.ArgumentTypeError('expected CMD=CYCLES, got %r' % arg)
+	return (m.group(1), int(m.group(2)))
+
+def asm2basic(infile, isa):
+	'''
+	expands pseudo-instructions into one basic ASM line per statement
+	args:
+		infile = ASM file
+		isa = the ISA dict
+	returns:
+		list of Stmt records, one per basic ASM line
+	'''
+	stmts = []
 	text = False
-	for i, line in enumerate(infile):
-		line = clean_line(line)
+	constants.clear()
+	expr_operands.clear()
+	expr_names.clear()
+	expr_texts.clear()
+	for i, source in enumerate(infile):
+		line = clean_line(source)
 		if re.match('(?:#.*)?$', line): # skip comments and blank lines
 			continue
+		source = source.rstrip()
+		m = re.match('\s*\.(?:eqv|set)\s+([A-Za-z_]\w*)\s*,?\s*([^#]+)', source)
+		if m: # named constant, e.g. '.eqv SIZE, 4*8'
+			constants[m.group(1)] = fold_constants(parse_expr(m.group(2).strip()))
+			continue
 		m = re.match('\.\w+', line)
 		if m:
 			if m.group(0) == '.text':
@@ -149,19 +347,380 @@ def asm2basic(infile, outfile, isa):
 			elif m.group(0) == '.data':
 				data = True
 				text = False
+		elif text:
+			line = clean_line(expand_exprs(source))
 		if text:
 			isa_key, isa_val = find_cmd(line, isa)
 			if isa_val:
 				if re.match('[^01]', isa_val):
 					m = re.match('\w+:', line)
 					if m:
-						outfile.write(m.group(0) + '\n')
+						stmts.append(Stmt(m.group(0), i+1, source, None))
 					cmds = pseudo2real(line, isa_key, isa_val)
 					print(cmds) if debug else None
-					for c in cmds:
-						outfile.write(c + '\n')
+					stmts.extend(Stmt(c, i+1, source, isa_key) for c in cmds)
 					continue
-		outfile.write(line + '\n')
+		stmts.append(Stmt(line, i+1, source, None))
+	return stmts
+
+def fill_delay_slots(stmts, isa):
+	'''
+	moves an independent instruction from before each branch or jump into the
+	'nop' padding its delay slot
+	args:
+		stmts = list of Stmt records of basic (pseudo-expanded) ASM lines
+		isa = the ISA dict
+	returns:
+		tuple of (scheduled Stmt list, number of slots filled, number of nop slots)
+	'''
+	stmts = list(stmts)
+	lines = [x.text for x in stmts]
+	pos = text_stmts(lines)
+	filled = slots = 0
+	for k, (bi, labeled) in enumerate(pos[:-1]):
+		b = parse_cmd(lines[bi])
+		ni, nop_labeled = pos[k+1]
+		if not is_control(b[0]) or b[0] == 'syscall' \
+			or parse_cmd(lines[ni]) != ['nop'] or nop_labeled:
+			continue
+		slots += 1
+		if labeled: # moving code past a branch target changes its meaning
+			continue
+		defs, uses = get_defs_uses(lines[bi], isa)
+		# walk back through the basic block looking for a movable instruction
+		for c in range(k-1, -1, -1):
+			ci, c_labeled = pos[c]
+			if lines[ci] is None: # already moved into an earlier delay slot
+				continue
+			c_cmd = parse_cmd(lines[ci])
+			if is_control(c_cmd[0]) \
+				or c > 0 and is_control(parse_cmd(lines[pos[c-1][0]] or 'nop')[0]):
+				break # reached the previous block or another delay slot
+			c_defs, c_uses = get_defs_uses(lines[ci], isa)
+			if not c_labeled and c_cmd != ['nop'] \
+				and not c_defs & (defs | uses) and not c_uses & defs:
+				print('delay slot: %r <- %r' % (lines[bi], lines[ci])) \
+					if debug else None
+				lines[ni], stmts[ni] = lines[ci], stmts[ci]
+				lines[ci] = stmts[ci] = None
+				filled += 1
+				break
+			if c_labeled:
+				break
+			defs |= c_defs
+			uses |= c_uses
+	return ([x for x in stmts if x is not None], filled, slots)
+
+def schedule_blocks(stmts, isa):
+	'''
+	list-schedules the instructions of each basic block so that dependent
+	commands issue after the producing command's latency has elapsed
+	args:
+		stmts = list of Stmt records of basic (pseudo-expanded) ASM lines
+		isa = the ISA dict
+	returns:
+		tuple of (scheduled Stmt list, estimated stalls before, estimated stalls after)
+	'''
+	stmts = list(stmts)
+	lines = [x.text for x in stmts]
+	before = after = 0
+	for block in basic_blocks(lines):
+		idx = [i for i, labeled in block]
+		instrs = [(parse_cmd(lines[i])[0],) + get_defs_uses(lines[i], isa)
+				for i in idx]
+		# the terminating branch and its delay slot keep their places
+		tail = next((j for j, x in enumerate(instrs) if is_control(x[0])), len(idx))
+		order = list_schedule(instrs[:tail], isa.latencies) \
+			+ list(range(tail, len(idx)))
+		stalls = count_stalls(instrs, isa.latencies)
+		new_stalls = count_stalls([instrs[x] for x in order], isa.latencies)
+		before += stalls
+		if new_stalls >= stalls:
+			after += stalls
+			continue
+		after += new_stalls
+		# the label stays with the first instruction of the block
+		m = re.match('\w+:\s*', lines[idx[0]])
+		label = m.group(0) if m else ''
+		block_stmts = [stmts[i]._replace(text=re.sub('^\w+:\s*', '', lines[i]))
+					for i in idx]
+		for i, x in zip(idx, order):
+			stmts[i] = block_stmts[x]
+		stmts[idx[0]] = stmts[idx[0]]._replace(text=label + stmts[idx[0]].text)
+		print('scheduled %r' % [stmts[i].text for i in idx]) if debug else None
+	return (stmts, before, after)
+
+def list_schedule(instrs, latencies):
+	'''
+	orders a basic block by greedy list scheduling, issuing whichever ready
+	command can start earliest and breaking ties by critical path length
+	args:
+		instrs = list of (command name, defs, uses) tuples in program order
+		latencies = command name -> result latency, see ISA
+	returns:
+		list of indices into instrs in issue order
+	'''
+	preds = [{} for x in instrs] # predecessor index -> required distance
+	succs = [[] for x in instrs]
+	last_def = {}
+	readers = {}
+	for q, (name, defs, uses) in enumerate(instrs):
+		for r in uses: # read after write
+			if r in last_def:
+				p = last_def[r]
+				preds[q][p] = max(preds[q].get(p, 0),
+								latencies.get(instrs[p][0], 1))
+		for r in defs: # write after write and write after read
+			for p in readers.get(r, []) + ([last_def[r]] if r in last_def else []):
+				if p != q:
+					preds[q].setdefault(p, 1)
+		for r in uses:
+			readers.setdefault(r, []).append(q)
+		for r in defs:
+			last_def[r] = q
+			readers[r] = []
+		for p in preds[q]:
+			succs[p].append(q)
+	height = [0] * len(instrs)
+	for p in range(len(instrs)-1, -1, -1):
+		height[p] = max([1] + [preds[q][p] + height[q] for q in succs[p]])
+	order = []
+	issued = {}
+	waiting = [len(x) for x in preds]
+	ready = [q for q in range(len(instrs)) if not waiting[q]]
+	t = -1
+	while ready:
+		start = lambda q: max([t + 1] + [issued[p] + d for p, d in preds[q].items()])
+		q = min(ready, key=lambda q: (start(q), -height[q], q))
+		t = start(q)
+		issued[q] = t
+		order.append(q)
+		ready.remove(q)
+		for s in succs[q]:
+			waiting[s] -= 1
+			if not waiting[s]:
+				ready.append(s)
+	return order
+
+def count_stalls(instrs, latencies):
+	'''
+	estimates interlock stalls for commands issued in order on a single-issue
+	pipeline, where a result is available latencies[name] cycles after issue
+	args:
+		instrs = list of (command name, defs, uses) tuples in issue order
+		latencies = command name -> result latency, see ISA
+	returns:
+		number of stall cycles
+	'''
+	avail = {}
+	t = -1
+	for name, defs, uses in instrs:
+		t = max([t + 1] + [avail.get(r, 0) for r in uses])
+		for r in defs:
+			avail[r] = t + latencies.get(name, 1)
+	return t + 1 - len(instrs)
+
+def basic_blocks(lines):
+	'''
+	splits the .text instructions into basic blocks, which start at a label
+	or after a branch or jump and end at the next syscall or the delay slot
+	of the next branch or jump
+	args:
+		lines = list of basic ASM lines
+	returns:
+		list of blocks, each a list of (line index, labeled) tuples
+	'''
+	blocks = []
+	end = True # the previous instruction ended a block
+	slot = False # the next instruction is a delay slot
+	for i, labeled in text_stmts(lines):
+		if labeled or end:
+			blocks.append([])
+		blocks[-1].append((i, labeled))
+		cmd = parse_cmd(lines[i])[0]
+		end = slot or cmd == 'syscall'
+		slot = not slot and is_control(cmd) and cmd != 'syscall'
+	return blocks
+
+BlockTiming = collections.namedtuple('BlockTiming',
+									'addr label instrs stalls cycles')
+
+def get_timing(stmts, isa, branch_penalty=1):
+	'''
+	estimates the cost of each basic block on an in-order 5-stage pipeline
+	args:
+		stmts = list of Stmt records, as laid out in the .text segment
+		isa = the ISA dict
+		branch_penalty = cycles lost when a block ends in a branch or jump
+	returns:
+		list of BlockTiming tuples in address order, labeled with the nearest
+		preceding label plus an offset
+	'''
+	lines = [x.text for x in stmts]
+	timing = []
+	addr = text_start_addr
+	label = None
+	label_addr = addr
+	for block in basic_blocks(lines):
+		instrs = [(parse_cmd(lines[i])[0],) + get_defs_uses(lines[i], isa)
+				for i, l in block]
+		if block[0][1]:
+			label = block[0][1]
+			label_addr = addr
+		stalls = count_stalls(instrs, isa.latencies)
+		cycles = len(instrs) + stalls
+		if any(is_control(x[0]) and x[0] != 'syscall' for x in instrs[-2:]):
+			cycles += branch_penalty
+		name = label or '.text'
+		if addr != label_addr:
+			name += '+0x%x' % (addr - label_addr)
+		timing.append(BlockTiming(addr, name, len(instrs), stalls, cycles))
+		addr += 4 * len(instrs)
+	return timing
+
+def print_timing(timing):
+	'''prints block and label costs from get_timing(), most expensive first'''
+	fmt = '%-10s %-24s %7s %7s %7s %7s'
+	print('Basic blocks by estimated cycles:')
+	print(fmt % ('address', 'block', 'instrs', 'stalls', 'cycles', 'bytes'))
+	for b in sorted(timing, key=lambda b: (-b.cycles, b.addr)):
+		print(fmt % ('0x%08x' % b.addr, b.label, b.instrs, b.stalls,
+					b.cycles, 4 * b.instrs))
+	labels = collections.OrderedDict()
+	for b in timing:
+		name = re.sub('\+0x[0-9a-f]+$', '', b.label)
+		if name not in labels:
+			labels[name] = BlockTiming(b.addr, name, 0, 0, 0)
+		l = labels[name]
+		labels[name] = l._replace(instrs=l.instrs + b.instrs,
+								stalls=l.stalls + b.stalls,
+								cycles=l.cycles + b.cycles)
+	print('Labels by estimated cycles:')
+	print(fmt % ('address', 'label', 'instrs', 'stalls', 'cycles', 'bytes'))
+	for l in sorted(labels.values(), key=lambda l: (-l.cycles, l.addr)):
+		print(fmt % ('0x%08x' % l.addr, l.label, l.instrs, l.stalls,
+					l.cycles, 4 * l.instrs))
+
+def text_stmts(lines):
+	'''
+	finds the instructions of the .text segment
+	args:
+		lines = list of basic ASM lines
+	returns:
+		list of (line index, label) tuples, where label names the (last)
+		label on instructions that may be the target of a branch or jump
+		and is None otherwise
+	'''
+	stmts = []
+	data = False
+	label = None
+	for i, line in enumerate(lines):
+		if re.match('(?:#.*)?$', line):
+			continue
+		m = re.match('\.\w+', line)
+		if m:
+			if m.group(0) == '.data':
+				data = True
+			elif m.group(0) == '.text':
+				data = False
+			continue
+		if data:
+			continue
+		m = re.match('(\w+):', line)
+		if m:
+			label = m.group(1)
+			if not line[m.end():].strip(): # label goes w/ next line
+				continue
+		stmts.append((i, label))
+		label = None
+	return stmts
+
+def is_control(cmd):
+	'''returns True if the command name transfers control or traps'''
+	return cmd in branch_cmds or cmd in jump_cmds or cmd == 'syscall'
+
+def reg_num(reg):
+	'''returns the register number for a register name (e.g. '$t0' or '$8')'''
+	m = re.match('\$0*([0-9]|[12][0-9]|3[01])$', reg)
+	if m:
+		return int(m.group(1))
+	try:
+		return regs.index(reg)
+	except ValueError:
+		raise ASMError('Invalid register %r' % reg)
+
+def get_defs_uses(asm, isa):
+	'''
+	determines which registers a basic (non-pseudo) command writes and reads
+	args:
+		asm = basic ASM line
+		isa = the ISA dict
+	returns:
+		tuple of (defs, uses) sets holding register numbers, floating point
+		register names ('f0' to 'f31') and the pseudo-registers 'hi', 'lo',
+		'fcc' (FPU condition codes) and 'mem'
+	'''
+	isa_key, binstr = find_cmd(asm, isa)
+	if not isa_key:
+		raise ASMError('Command not found: ' + asm)
+	cmd = parse_cmd(asm)
+	fields = {}
+	for asm_arg, isa_arg in zip(cmd[1:], parse_cmd(isa_key)[1:]):
+		kind = isa.fields.get(isa_arg, (None, None))[1]
+		if kind == 'gpr':
+			fields[isa_arg[1:]] = set([reg_num(asm_arg)])
+		elif kind == 'fpr':
+			n = int(re.sub('\$f', '', asm_arg))
+			fields[isa_arg[1:]] = set(['f%d' % n])
+			# double precision values occupy an even/odd register pair
+			if 'd' in cmd[0].split('.')[1:] or cmd[0] in ('ldc1','sdc1'):
+				fields[isa_arg[1:]].add('f%d' % (n | 1))
+	get = lambda k: fields.get(k, set())
+	defs = get('d') | get('fd')
+	uses = get('s') | get('fs') | get('ft')
+	if cmd[0] == 'mtc1':
+		defs, uses = get('fs'), get('t')
+	elif cmd[0] in ('lwc1','ldc1'):
+		defs, uses = get('ft'), get('s')
+	elif re.match('mov[nz]\.', cmd[0]): # FP conditional move on a GPR
+		uses |= get('t') | get('fd') # fd keeps its old value if the test fails
+	elif 't' in fields:
+		# rt is a destination for I-type commands other than stores and branches
+		if 'd' in fields or binstr.startswith('000000') or cmd[0] in store_cmds \
+			or cmd[0] in branch_cmds or cmd[0] in hilo_cmds:
+			uses |= get('t')
+		else:
+			defs |= get('t')
+	if cmd[0] in merge_cmds:
+		uses |= defs
+	if cmd[0] in link_cmds and not 'd' in fields:
+		defs.add(31)
+	if cmd[0] in hilo_cmds or cmd[0] == 'mul': # mul leaves HI/LO unpredictable
+		defs.update(('hi', 'lo'))
+	if cmd[0] in acc_cmds:
+		uses.update(('hi', 'lo'))
+	elif cmd[0] == 'mfhi':
+		uses.add('hi')
+	elif cmd[0] == 'mflo':
+		uses.add('lo')
+	elif cmd[0] == 'mthi':
+		defs.add('hi')
+	elif cmd[0] == 'mtlo':
+		defs.add('lo')
+	elif cmd[0] in load_cmds:
+		uses.add('mem')
+	elif cmd[0] in store_cmds:
+		defs.add('mem')
+	elif cmd[0].startswith('c.'):
+		defs.add('fcc')
+	elif cmd[0] in ('bc1t','bc1f'):
+		uses.add('fcc')
+	elif cmd[0] == 'syscall':
+		uses.update((2, 4, 5, 6, 7, 'mem'))
+		defs.update((2, 'mem'))
+	defs.discard(0) # writes to $zero are discarded
+	uses.discard(0)
+	return (defs, uses)
 
 def get_labels(infile):
 	skip = False
@@ -203,6 +762,9 @@ def get_labels(infile):
 				if not skip:
 					data_seg.extend([x for x in re.split('\s+', line)[2:] if x.isdigit()])
 					data_labels.extend([None for x in re.split('\s+', line)[2:] if x])
+			elif m.group(1).isdigit(): # numeric local label, kept out of the symbols
+				local_labels.setdefault(m.group(1), array.array('I')).append(len(text_labels))
+				text_labels.append(None)
 			else: # default to .text segment, even if not explicitly declared
 				text_labels.append(m.group(1))
 		else:
@@ -212,6 +774,100 @@ def get_labels(infile):
 				text_labels.append(None)
 	print('text_labels = %r\ndata_labels = %r' % (text_labels, data_labels)) if debug else None
 
+def local_label(name, direction, linenum):
+	'''
+	finds the command a numeric local label reference points to
+	args:
+		name = label number, e.g. '1'
+		direction = 'b' for the nearest definition at or before the command
+			making the reference, 'f' for the nearest one after it
+		linenum = index of the command making the reference
+	returns:
+		the .text command index of the label
+	'''
+	indices = local_labels.get(name, ())
+	k = bisect.bisect_right(indices, linenum) - (direction == 'b')
+	if not 0 <= k < len(indices):
+		raise ASMError('Local label %r not found' % (name + direction))
+	return indices[k]
+
+def freeze_labels():
+	'''builds the label lookup tables once the label lists are complete'''
+	text_symbols.clear()
+	data_symbols.clear()
+	expr_values.clear()
+	for symbols, labels in ((text_symbols, text_labels), (data_symbols, data_labels)):
+		for i, label in enumerate(labels):
+			if label is not None:
+				symbols.setdefault(label, i)
+
+def encode_text(stmts, isa, jobs=1, min_chunk=4096):
+	'''
+	encodes the .text commands once the labels are laid out, optionally
+	splitting the work across a pool of worker processes
+	args:
+		stmts = list of basic ASM lines, one per .text command
+		isa = the ISA dict
+		jobs = number of worker processes, or 0 for one per core
+		min_chunk = smallest number of commands worth sending to a worker
+	returns:
+		list of hex strings, in command order
+	'''
+	jobs = jobs or os.cpu_count() or 1
+	if jobs == 1 or len(stmts) < 2 * min_chunk:
+		return encode_chunk(0, stmts, isa)
+	size = max(min_chunk, -(-len(stmts) // (4 * jobs)))
+	hexstrs = []
+	# ship the ISA and symbol tables once per worker rather than per chunk
+	with concurrent.futures.ProcessPoolExecutor(jobs, initializer=init_encoder,
+			initargs=(isa, text_labels, data_labels, local_labels, expr_operands,
+					debug, memo_size)) as pool:
+		chunks = [pool.submit(encode_worker_chunk, k, stmts[k:k+size])
+				for k in range(0, len(stmts), size)]
+		for c in chunks:
+			chunk, stats = c.result()
+			hexstrs.extend(chunk)
+			memo_stats.update(stats)
+	return hexstrs
+
+def init_encoder(isa, text, data, local, exprs, dbg, memo):
+	'''sets up the assembler state in an encode_text() worker process'''
+	global debug, worker_isa, memo_size
+	debug = dbg
+	worker_isa = isa
+	memo_size = memo
+	text_labels[:] = text
+	data_labels[:] = data
+	local_labels.update(local)
+	expr_operands.update(exprs)
+	freeze_labels()
+
+def encode_worker_chunk(start, stmts):
+	'''encodes a chunk in a worker, returning its hex strings and memo stats'''
+	before = memo_stats.copy()
+	hexstrs = encode_chunk(start, stmts)
+	return (hexstrs, memo_stats - before)
+
+def encode_chunk(start, stmts, isa=None):
+	'''
+	encodes consecutive .text commands
+	args:
+		start = command index of the first statement
+		stmts = list of basic ASM lines
+		isa = the ISA dict (defaults to the one given to init_encoder())
+	returns:
+		list of hex strings
+	'''
+	isa = isa or worker_isa
+	hexstrs = []
+	for j, line in enumerate(stmts, start):
+		print('j=%d ' % j + '-'*70) if debug else None
+		binstr = get_encoding(line, j, isa)
+		hexstr = binstr2hexstr(binstr)
+		print('%s -> %s' % (hexstr, binstr)) if debug else None
+		hexstrs.append(hexstr)
+	return hexstrs
+
 def pseudo2real(asm, isa_key, isa_val):
 	#isa_cmds = list of strings, each representing an ASM command
 	asm_cmd = parse_cmd(asm)
@@ -227,6 +883,482 @@ def pseudo2real(asm, isa_key, isa_val):
 				isa_cmds[i][arg_idx] = asm_arg
 	return [' '.join(x) for x in isa_cmds]
 
+def write_image(f, words, fmt='hex', depth=None, width=32, addr_radix=16,
+				data_radix=16, fill=0):
+	'''
+	writes a memory image for loading into block RAM, built as one string
+	args:
+		f = output file
+		words = list of 32-bit words
+		fmt = 'hex' (one hex word per line), 'coe' (Xilinx), 'mif' (Intel/Altera),
+			'memh' or 'memb' (Verilog $readmemh/$readmemb)
+		depth = number of memory words, padded with fill (default: no padding)
+		width = bits per memory word; 32-bit words are split big-endian or
+			packed to fit
+		addr_radix = MIF address radix
+		data_radix = COE/MIF data radix
+		fill = value of padding memory words
+	'''
+	if width < 1 or (32 % width if width < 32 else width % 32):
+		raise ASMError('Memory width must divide or be a multiple of 32, got %d' % width)
+	if not 0 <= fill < 1 << width:
+		raise ASMError('Fill value %#x does not fit in %d bits' % (fill, width))
+	radix = 2 if fmt == 'memb' else data_radix if fmt in ('coe', 'mif') else 16
+	n, data = format_words(words, width, radix)
+	depth = n if depth is None else depth
+	if n > depth:
+		raise ASMError('%d memory words do not fit in a depth of %d' % (n, depth))
+	fill = format_words([fill], width, radix, 1)[1]
+	if fmt == 'mif':
+		names = {2: 'BIN', 8: 'OCT', 10: 'UNS', 16: 'HEX'}
+		digits = 8 if addr_radix == 16 else len(radix_str(max(depth - 1, 0), addr_radix))
+		addr = '{:0%d%s}' % (digits, {2: 'b', 8: 'o', 10: 'd', 16: 'x'}[addr_radix])
+		out = ['-- %s memory image' % f.name, 'WIDTH=%d;' % width,
+			'DEPTH=%d;' % depth, 'ADDRESS_RADIX=%s;' % names[addr_radix],
+			'DATA_RADIX=%s;' % names[radix], '', 'CONTENT BEGIN']
+		if n:
+			if addr_radix == 16:
+				addrs = format_words(list(range(n)), 32, 16)[1].split('\n')
+			else:
+				addrs = map(addr.format, range(n))
+			out.append('\t' + ';\n\t'.join(map(' : '.join,
+					zip(addrs, data.split('\n')))) + ';')
+		if n < depth:
+			out.append('\t[%s..%s] : %s;' % (addr.format(n), addr.format(depth - 1), fill))
+		out.append('END;')
+	else:
+		data = '\n'.join(([data] if n else []) + [fill] * (depth - n))
+		if fmt == 'coe':
+			out = ['; %s memory image' % f.name,
+				'memory_initialization_radix=%d;' % radix,
+				'memory_initialization_vector=', data.replace('\n', ',\n') + ';']
+		elif fmt in ('memh', 'memb'):
+			out = ['// %s memory image' % f.name, '@0', data]
+		else:
+			out = [data] if data else []
+	f.write('\n'.join(out) + '\n' if out else '')
+
+def format_words(words, width, radix, count=None):
+	'''
+	formats 32-bit words as newline separated memory words of width bits,
+	splitting them big-endian or packing them as needed; 8, 16, 32 and 64
+	bit words are formatted by a single bytes.hex() call
+	args:
+		words = list of 32-bit words (or memory words, if count is given)
+		width = bits per memory word
+		radix = 2, 10 or 16
+		count = number of memory words, if words are already width bits wide
+	returns:
+		tuple of (number of memory words, formatted string)
+	'''
+	if count is None and width in (8, 16, 32, 64) and radix != 10:
+		if width > 32:
+			words = words + [0] * (-len(words) % (width // 32))
+		b = array.array('I', words)
+		if sys.byteorder == 'little':
+			b.byteswap()
+		b = b.tobytes()
+		data = b.hex('\n', width // 8) if b else ''
+		return (len(b) * 8 // width, data.translate(hex2bin) if radix == 2 else data)
+	if count is None:
+		words = resize_words(words, width)
+	fmt = {2: '{:0%db}' % width, 10: '{:d}', 16: '{:0%dx}' % -(-width // 4)}[radix]
+	return (len(words), '\n'.join(map(fmt.format, words)))
+
+def resize_words(words, width):
+	'''splits (big-endian) or packs 32-bit words into width-bit memory words'''
+	if width == 32:
+		return words
+	if width < 32 and not 32 % width:
+		n = 32 // width
+		return [(w >> (width * (n - 1 - k))) & ((1 << width) - 1)
+				for w in words for k in range(n)]
+	if width > 32 and not width % 32:
+		n = width // 32
+		words = words + [0] * (-len(words) % n)
+		return [sum(w << (32 * (n - 1 - k)) for k, w in enumerate(words[i:i+n]))
+				for i in range(0, len(words), n)]
+	raise ASMError('Memory width must divide or be a multiple of 32, got %d' % width)
+
+def radix_str(i, radix):
+	'''formats a non-negative int in base 2, 8, 10 or 16'''
+	return {2: '{:b}', 8: '{:o}', 10: '{:d}', 16: '{:x}'}[radix].format(i)
+
+def read_image(filename, fmt=None, as_numpy=False):
+	'''
+	reads a memory image of 32-bit words in bulk, decoding the whole file
+	with one bytes.fromhex() call where it can rather than word by word
+	args:
+		filename = image file
+		fmt = 'hex' (one hex word per line, as written by mipster or MARS),
+			'ihex' (Intel HEX, from its lowest address), 'raw' (big-endian
+			binary words), or None to tell from the file
+		as_numpy = return a NumPy uint32 array rather than an array('I')
+	returns:
+		array of words
+	'''
+	with open(filename, 'rb') as f:
+		b = f.read()
+	if fmt is None:
+		fmt = ('raw' if os.path.splitext(filename)[1] == '.bin'
+			else 'ihex' if b.lstrip()[:1] == b':' else 'hex')
+	if fmt == 'hex':
+		try:
+			words = bytes.fromhex(b.decode('ascii'))
+		except ValueError:
+			words = None
+		# only trust the joined stream if every word has all 8 digits
+		n = len(words) // 4 if words is not None else 0
+		if words is None or len(b) != 9 * n or b[8::9] != b'\n' * n:
+			try:
+				words = b''.join(int(x, 16).to_bytes(4, 'big') for x in b.split())
+			except (ValueError, OverflowError):
+				raise ASMError('%s is not a hex image of 32-bit words' % filename)
+	elif fmt == 'ihex':
+		words = read_ihex(b, filename)
+	elif fmt == 'raw':
+		words = b[:len(b) & ~3]
+	else:
+		raise ASMError('Unknown image format %r' % fmt)
+	if as_numpy:
+		import numpy
+		return numpy.frombuffer(words, '>u4').astype(numpy.uint32)
+	a = array.array('I', words)
+	if sys.byteorder == 'little':
+		a.byteswap()
+	return a
+
+def compare_text(hexstrs, stmts, isa, filename, limit=20):
+	'''
+	compares the encoded .text commands to a reference image, printing the
+	address, expected and actual disassembly and source line of mismatches
+	args:
+		hexstrs = list of hex strings, in command order
+		stmts = Stmt records of the .text commands
+		isa = the ISA dict
+		filename = reference image, e.g. a MARS hex dump
+		limit = number of mismatches to print
+	returns:
+		number of mismatching words
+	'''
+	import mipsim # the disassembler lives with the simulator, which imports us
+	words = array.array('I', bytes.fromhex(''.join(hexstrs)))
+	if sys.byteorder == 'little':
+		words.byteswap()
+	decoder = mipsim.make_decoder(isa)
+	def row(i, expected, actual):
+		text = lambda w: '' if w is None else mipsim.disassemble(isa, decoder, w,
+												text_start_addr + 4*i)
+		source = '%d: %s' % (stmts[i].lineno, stmts[i].source.strip()) if i < len(stmts) else ''
+		return '%08x  %8s  %8s  %-26s %-26s %s' % (text_start_addr + 4*i,
+			word_str(expected), word_str(actual), text(expected), text(actual), source)
+	head = '%-8s  %-8s  %-8s  %-26s %-26s %s' % ('address', 'expected', 'actual',
+		'expected command', 'actual command', 'source')
+	return compare_words('Text', words, read_image(filename), filename, head, row, limit)
+
+def compare_data(filename, limit=20):
+	'''
+	compares the .data words to a reference image, printing the address,
+	expected and actual value and nearest label of mismatches; words past
+	the end of either image count as zero, since dumps cover a whole region
+	args:
+		filename = reference image, e.g. a MARS hex dump
+		limit = number of mismatches to print
+	returns:
+		number of mismatching words
+	'''
+	words = array.array('I', [int(n) & 0xffffffff for n in data_seg])
+	ref = read_image(filename)
+	n = max(len(words), len(ref))
+	words.frombytes(bytes(4 * (n - len(words))))
+	ref.frombytes(bytes(4 * (n - len(ref))))
+	def row(i, expected, actual):
+		k = i
+		while k >= 0 and not (k < len(data_labels) and data_labels[k]):
+			k -= 1
+		label = '' if k < 0 else data_labels[k] + ('+0x%x' % (4*(i - k)) if i > k else '')
+		return '%08x  %8s  %8s  %s' % ((data_start_addr << 16) + 4*i,
+			word_str(expected), word_str(actual), label)
+	head = '%-8s  %-8s  %-8s  %s' % ('address', 'expected', 'actual', 'label')
+	return compare_words('Data', words, ref, filename, head, row, limit)
+
+def compare_words(name, words, ref, filename, head, row, limit):
+	'''
+	finds the words that differ from a reference with a vectorized equality
+	check (NumPy if available, else a whole-array comparison first) and
+	prints a table of the first limit of them
+	args:
+		name = segment name for the report
+		words, ref = arrays of actual and expected words
+		filename = reference image name for the report
+		head = table header
+		row = function of a word index and the expected and actual words
+			(None past the end of an image), returning a table row
+		limit = number of mismatches to print
+	returns:
+		number of mismatching words
+	'''
+	n = min(len(words), len(ref))
+	try:
+		import numpy
+		a = numpy.frombuffer(words, numpy.uint32, n)
+		b = numpy.frombuffer(ref, numpy.uint32, n)
+		bad = numpy.flatnonzero(a != b).tolist()
+	except ImportError:
+		bad = [] if words[:n] == ref[:n] else \
+			[i for i, (x, y) in enumerate(zip(words, ref)) if x != y]
+	bad += range(n, max(len(words), len(ref)))
+	if not bad:
+		print('%s matches %s (%d words)' % (name, filename, n))
+		return 0
+	print('%s differs from %s at %d of %d words%s:' % (name, filename, len(bad),
+		max(len(words), len(ref)), ' (%d expected, %d assembled)' % (len(ref), len(words))
+		if len(ref) != len(words) else ''))
+	print(head)
+	for i in bad[:limit]:
+		print(row(i, ref[i] if i < len(ref) else None,
+				words[i] if i < len(words) else None).rstrip())
+	if len(bad) > limit:
+		print('... %d more' % (len(bad) - limit))
+	return len(bad)
+
+def word_str(w):
+	'''formats a word for a comparison table, or dashes for a missing word'''
+	return '-' * 8 if w is None else '%08x' % w
+
+def read_ihex(b, filename):
+	'''returns the bytes of an Intel HEX image from its lowest address, zero filled'''
+	chunks = []
+	base = 0
+	for line in b.split():
+		try:
+			rec = bytes.fromhex(line[1:].decode('ascii'))
+		except ValueError:
+			rec = b''
+		if line[:1] != b':' or len(rec) < 5 or len(rec) != rec[0] + 5 or sum(rec) & 0xff:
+			raise ASMError('%s: invalid Intel HEX record %r' % (filename, line.decode('ascii', 'replace')))
+		kind = rec[3]
+		if kind == 0: # data
+			chunks.append((base + (rec[1] << 8 | rec[2]), rec[4:-1]))
+		elif kind == 1: # end of file
+			break
+		elif kind == 2: # extended segment address
+			base = (rec[4] << 8 | rec[5]) << 4
+		elif kind == 4: # extended linear address
+			base = (rec[4] << 8 | rec[5]) << 16
+	if not chunks:
+		return b''
+	start = min(a for a, d in chunks)
+	image = bytearray(max(a + len(d) for a, d in chunks) - start)
+	for a, d in chunks:
+		image[a - start:a - start + len(d)] = d
+	image.extend(bytes(-len(image) % 4))
+	return bytes(image)
+
+def write_listing(f, stmts, hexstrs):
+	'''
+	writes an assembly listing of the .text segment and a symbol table
+	args:
+		f = output file
+		stmts = Stmt records of the .text commands, in address order
+		hexstrs = encoding of each command
+	'''
+	out = ['%-8s  %-8s  %5s  %-28s %-16s %s'
+		% ('address', 'word', 'line', 'command', 'expanded from', 'source')]
+	prev = None
+	for i, (stmt, hexstr) in enumerate(zip(stmts, hexstrs)):
+		first = stmt.lineno != prev # source text goes with its first command
+		prev = stmt.lineno
+		out.append(('%08x  %s  %5s  %-28s %-16s %s'
+			% (text_start_addr + 4*i, hexstr, stmt.lineno if first else '',
+			listing_text(stmt.text), stmt.pseudo or '',
+			stmt.source.strip() if first else '')).rstrip())
+	out.extend(['', 'Symbol table:', '%-8s  %-5s  %s' % ('address', 'seg', 'label')])
+	symbols = [(text_start_addr + 4*i, '.text', l) for l, i in text_symbols.items()]
+	symbols += [((data_start_addr << 16) + 4*i, '.data', l)
+				for l, i in data_symbols.items()]
+	out.extend('%08x  %-5s  %s' % x for x in sorted(symbols))
+	f.write('\n'.join(out) + '\n')
+
+def listing_text(text):
+	'''returns a command without its label, with placeholders shown as written'''
+	return re.sub('\\b_expr\\d+\\b', lambda m: expr_texts.get(m.group(), m.group()),
+		re.sub('^\\w+:\\s*', '', text))
+
+def write_debug_info(f, stmts, filename):
+	'''
+	writes the binary debug sidecar read by DebugInfo: debug_header, then
+	little-endian 32-bit arrays of line table addresses, line numbers and
+	file name offsets, of symbol addresses and symbol name offsets, and
+	finally a string table of NUL terminated names
+	args:
+		f = output file, opened in binary mode
+		stmts = Stmt records of the .text commands, in address order
+		filename = name of the ASM source file
+	'''
+	symbols = [(text_start_addr + 4*i, l) for l, i in text_symbols.items()]
+	symbols += [((data_start_addr << 16) + 4*i, l) for l, i in data_symbols.items()]
+	symbols.sort()
+	strtab = bytearray()
+	offsets = {}
+	for name in [filename] + [l for a, l in symbols]:
+		if name not in offsets:
+			offsets[name] = len(strtab)
+			strtab += name.encode() + b'\0'
+	rows = [] # one row per run of commands from the same source line
+	for i, stmt in enumerate(stmts):
+		if not rows or rows[-1][1] != stmt.lineno:
+			rows.append((text_start_addr + 4*i, stmt.lineno))
+	arrays = [array.array('I', [a for a, l in rows]),
+			array.array('I', [l for a, l in rows]),
+			array.array('I', [offsets[filename]] * len(rows)),
+			array.array('I', [a for a, l in symbols]),
+			array.array('I', [offsets[l] for a, l in symbols])]
+	f.write(debug_header.pack(debug_magic, text_start_addr,
+							text_start_addr + 4*len(stmts), len(rows),
+							len(symbols), len(strtab)))
+	for a in arrays:
+		if sys.byteorder == 'big':
+			a.byteswap()
+		f.write(a.tobytes())
+	f.write(strtab)
+
+def get_relocations(lines):
+	'''
+	finds the .text words holding absolute addresses, which must be patched
+	to load the program at another base: jump targets, and the upper (and
+	lower) halves of addresses built with lui; label offsets into a segment
+	and branch offsets do not depend on the base
+	args:
+		lines = list of basic ASM lines, one per .text command
+	returns:
+		array of relocations, each a command index << 3 | reloc_kinds index
+	'''
+	relocs = array.array('I')
+	for j, line in enumerate(lines):
+		cmd = parse_cmd(line)
+		for a in cmd[1:]:
+			if a in expr_operands:
+				kind = expr_reloc(cmd[0], expr_operands[a])
+			elif re.match('\$|-?\d+$', a):
+				continue
+			elif re.match('D', a):
+				kind = reloc_kinds.index('data hi16')
+			elif re.match('j', cmd[0]): # label or local label
+				kind = reloc_kinds.index('text j26')
+			else:
+				continue
+			if kind is not None:
+				relocs.append(j << 3 | kind)
+	return relocs
+
+def expr_reloc(cmd, node):
+	'''returns the reloc_kinds index for an expression operand of cmd, or None'''
+	if re.match('j', cmd):
+		return reloc_kinds.index('text j26')
+	if re.match('b', cmd) or node[0] not in ('%hi', '%lo'):
+		if expr_segments(node, ('%hi', '%lo')):
+			raise ASMError('Cannot relocate %s with operand %r' % (cmd, node))
+		return None # labels count from their segment start
+	segs = expr_segments(node[1])
+	if len(segs) > 1:
+		raise ASMError('Cannot relocate %s with operand %r' % (cmd, node))
+	return reloc_kinds.index('%s %s16' % (segs.pop(), node[0][1:])) if segs else None
+
+def expr_segments(node, within=None):
+	'''
+	returns the set of segments ('text', 'data') of the labels in an
+	expression tree, only counting those inside a node kind in within if given
+	'''
+	segs = set()
+	if node[0] == 'sym' and within is None:
+		segs.add('text' if node[1] in text_symbols else 'data')
+	elif node[0] != 'num':
+		inside = None if node[0] in (within or ()) else within
+		for x in node[1:]:
+			if isinstance(x, tuple):
+				segs |= expr_segments(x, inside)
+	return segs
+
+def write_relocs(f, lines):
+	'''
+	writes the relocation file read by miprebase: reloc_header, then a
+	little-endian 32-bit array of relocations from get_relocations()
+	args:
+		f = output file, opened in binary mode
+		lines = list of basic ASM lines, one per .text command
+	'''
+	relocs = get_relocations(lines)
+	f.write(reloc_header.pack(reloc_magic, text_start_addr,
+							data_start_addr << 16, len(relocs)))
+	if sys.byteorder == 'big':
+		relocs.byteswap()
+	f.write(relocs.tobytes())
+
+class DebugInfo(object):
+	'''
+	maps addresses to source lines and symbols using a file written by
+	write_debug_info(); the file is mmapped and its sorted address arrays
+	are searched in place with bisect, so nothing is parsed up front
+	'''
+	def __init__(self, filename):
+		self.file = open(filename, 'rb')
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, self.text_start, self.text_end, n_rows, n_syms, n_str = \
+			debug_header.unpack_from(self.map)
+		if magic != debug_magic:
+			self.close()
+			raise ASMError('%s is not a mipster debug info file' % filename)
+		start = debug_header.size
+		self.words = memoryview(self.map)[start:start + 4*(3*n_rows + 2*n_syms)]
+		words = self.words.cast('I')
+		if sys.byteorder == 'big':
+			words = array.array('I', words)
+			words.byteswap()
+		self.line_addrs = words[:n_rows]
+		self.line_nums = words[n_rows:2*n_rows]
+		self.line_files = words[2*n_rows:3*n_rows]
+		self.sym_addrs = words[3*n_rows:3*n_rows + n_syms]
+		self.sym_names = words[3*n_rows + n_syms:]
+		self.strtab = start + 4*(3*n_rows + 2*n_syms)
+		self.labels = None
+
+	def string(self, offset):
+		'''returns the name at offset in the string table'''
+		start = self.strtab + offset
+		return self.map[start:self.map.find(b'\0', start)].decode()
+
+	def line(self, addr):
+		'''returns (file name, line number) of the command at addr, or None'''
+		if not self.text_start <= addr < self.text_end:
+			return None
+		i = bisect.bisect_right(self.line_addrs, addr) - 1
+		return (self.string(self.line_files[i]), self.line_nums[i])
+
+	def symbol(self, addr):
+		'''returns (label, offset) of the closest label at or below addr, or None'''
+		i = bisect.bisect_right(self.sym_addrs, addr) - 1
+		if i < 0:
+			return None
+		return (self.string(self.sym_names[i]), addr - self.sym_addrs[i])
+
+	def address(self, label):
+		'''returns the address of label, or None'''
+		if self.labels is None:
+			self.labels = dict((self.string(n), a)
+							for a, n in zip(self.sym_addrs, self.sym_names))
+		return self.labels.get(label)
+
+	def close(self):
+		for name in ('line_addrs', 'line_nums', 'line_files', 'sym_addrs', 'sym_names'):
+			view = getattr(self, name, None)
+			if isinstance(view, memoryview):
+				view.release()
+		if hasattr(self, 'words'):
+			self.words.release()
+		self.map.close()
+		self.file.close()
+
 def binstr2hexstr(binstr, hexdigs=8):
 	hexstr = str('%'+str(hexdigs)+'s') % hex(int(binstr, 2))[2:] # form the hex number
 	return re.sub('\s', '0', hexstr)
@@ -235,24 +1367,215 @@ def int2hexstr(i, hexdigs=8):
 	hexstr = str('%'+str(hexdigs)+'s') % hex(i)[2:] # form the hex number
 	return re.sub('\s', '0', hexstr)
 
+def expand_exprs(line):
+	'''
+	replaces the operand expressions and named constants of an ASM command by
+	their values, or by placeholder operands (see expr_operands) when they
+	name a label, since labels are only known after layout
+	args:
+		line = ASM source line in the .text segment
+	returns:
+		the line with simple operands only, ready for clean_line()
+	'''
+	code = re.sub('#.*', '', line)
+	m = re.match('(\s*(?:\w+:\s*)?[\w.]+)(?:\s+(.*))?$', code)
+	if not m or not m.group(2):
+		return line
+	if simple_operands.match(m.group(2)) and not (constants and
+			constants.keys() & re.findall('[A-Za-z_]\w*', m.group(2))):
+		return line
+	# split on top level commas, or on spaces if the operands have no commas
+	ops = ['']
+	depth = 0
+	sep = ',' if re.search(',', m.group(2)) else ' '
+	for c in m.group(2).strip():
+		depth += (c == '(') - (c == ')')
+		if depth == 0 and (c == sep or (sep == ' ' and c.isspace())):
+			ops.append('')
+		else:
+			ops[-1] += c
+	out = []
+	for op in ops:
+		op = op.strip()
+		if not op:
+			continue
+		base = ''
+		b = re.match('(.+?)\s*(\(\s*\$\w+\s*\))$', op)
+		if b: # offset(base register)
+			op, base = b.group(1), b.group(2)
+		out.append(expr_operand(op) + base)
+	return m.group(1) + ' ' + ', '.join(out)
+
+def expr_operand(text):
+	'''returns the simple operand standing for an operand expression'''
+	if re.match('\$\w+$|\(\s*\$\w+\s*\)$|-?\d+$|\d+[bf]$', text):
+		return text
+	if re.match('[A-Za-z_]\w*$', text) and text not in constants:
+		return text # bare label, resolved by translate_cmd()
+	node = fold_constants(parse_expr(text))
+	if node[0] == 'num':
+		return str(node[1])
+	name = expr_names.get(node)
+	if name is None:
+		name = expr_names[node] = '_expr%d' % len(expr_names)
+		expr_operands[name] = node
+		expr_texts[name] = text
+	return name
+
+def parse_expr(text):
+	'''
+	parses an operand expression, e.g. 'buf+4*N' or '%lo(table)', into a tree
+	of tuples, caching it by its text:
+		('num', value), ('sym', name), ('un', op, x), ('bin', op, x, y),
+		('%hi', x), ('%lo', x)
+	args:
+		text = expression source
+	returns:
+		the expression tree
+	'''
+	node = expr_cache.get(text)
+	if node is not None:
+		return node
+	tokens = []
+	pos = 0
+	while text[pos:].strip():
+		m = expr_token.match(text, pos)
+		if not m:
+			raise ASMError('Invalid expression %r' % text)
+		num, reloc, name, op = m.groups()
+		if num and re.match('[bf]\b', text[m.end():]):
+			raise ASMError('Local label %r cannot be used in an expression'
+						% (num + text[m.end()]))
+		if num:
+			tokens.append(('num', int(num, 0)))
+		elif name:
+			tokens.append(('sym', name))
+		else:
+			tokens.append(reloc or op)
+		pos = m.end()
+	tokens.append(None)
+	node, k = parse_binary(tokens, 0, 0, text)
+	if tokens[k] is not None:
+		raise ASMError('Invalid expression %r' % text)
+	expr_cache[text] = node
+	return node
+
+def parse_binary(tokens, k, level, text):
+	'''parses the operators of expr_levels[level] and tighter from tokens[k]'''
+	if level == len(expr_levels):
+		return parse_unary(tokens, k, text)
+	left, k = parse_binary(tokens, k, level+1, text)
+	while tokens[k] in expr_levels[level]:
+		op = tokens[k]
+		right, k = parse_binary(tokens, k+1, level+1, text)
+		left = ('bin', op, left, right)
+	return (left, k)
+
+def parse_unary(tokens, k, text):
+	'''parses a unary operator, %hi/%lo, parenthesis, number or name'''
+	t = tokens[k]
+	if t in ('-', '~', '+'):
+		x, k = parse_unary(tokens, k+1, text)
+		return (x if t == '+' else ('un', t, x), k)
+	if t in ('%hi', '%lo', '('):
+		if t != '(' and tokens[k+1] != '(':
+			raise ASMError('Expected ( after %s in %r' % (t, text))
+		x, k = parse_binary(tokens, k + (t != '(') + 1, 0, text)
+		if tokens[k] != ')':
+			raise ASMError('Unbalanced parentheses in %r' % text)
+		return (x if t == '(' else (t, x), k+1)
+	if isinstance(t, tuple):
+		return (t, k+1)
+	raise ASMError('Invalid expression %r' % text)
+
+def fold_constants(node):
+	'''
+	inlines the named constants of an expression tree and folds what it can,
+	so later .set redefinitions do not change it
+	'''
+	if node[0] == 'sym':
+		return constants.get(node[1], node)
+	if node[0] != 'num':
+		node = tuple(fold_constants(x) if isinstance(x, tuple) else x for x in node)
+	v = fold_expr(node)
+	return node if v is None else ('num', v)
+
+def fold_expr(node, resolve=False, absolute=False):
+	'''
+	evaluates an expression tree
+	args:
+		node = tree from parse_expr()
+		resolve = True once the labels are laid out, before which expressions
+			naming a label evaluate to None
+		absolute = labels are full addresses, as inside %hi() and %lo(),
+			rather than byte offsets into their segment like bare labels
+	returns:
+		the value as an int, or None
+	'''
+	kind = node[0]
+	if kind == 'num':
+		return node[1]
+	if kind == 'sym':
+		if not resolve:
+			return None
+		if node[1] in text_symbols:
+			return text_symbols[node[1]]*4 + (text_start_addr if absolute else 0)
+		if node[1] in data_symbols:
+			return data_symbols[node[1]]*4 + (data_start_addr << 16 if absolute else 0)
+		raise ASMError('Label %r not found' % node[1])
+	if kind in ('%hi', '%lo'):
+		v = fold_expr(node[1], resolve, True)
+		if v is None:
+			return None
+		if kind == '%hi': # rounded, so that %hi(x) << 16 plus %lo(x) is x
+			return ((v + 0x8000) >> 16) & 0xffff
+		return ((v & 0xffff) ^ 0x8000) - 0x8000
+	x = fold_expr(node[2], resolve, absolute)
+	if kind == 'un':
+		return None if x is None else (-x if node[1] == '-' else ~x)
+	y = fold_expr(node[3], resolve, absolute)
+	if x is None or y is None:
+		return None
+	try:
+		return expr_ops[node[1]](x, y)
+	except (ZeroDivisionError, ValueError):
+		raise ASMError('Cannot evaluate %r %s %r' % (x, node[1], y))
+
 def translate_cmd(line, linenum):
 	cmd = parse_cmd(line)
 	if len(cmd) > 1:
 		args = cmd[1:]
 		for i,a in enumerate(args):
+			if a in expr_operands: # expression naming a label, see expand_exprs()
+				v = expr_values.get(a)
+				if v is None:
+					v = expr_values[a] = fold_expr(expr_operands[a], True)
+				if re.match('j', cmd[0]): # labels count from the segment start
+					args[i] = str((v + text_start_addr) >> 2)
+				elif re.match('b', cmd[0]):
+					args[i] = str((v >> 2) - linenum - 1)
+				else:
+					args[i] = str(v)
+				continue
+			local = re.match('(\d+)([bf])$', a) # numeric local label, e.g. '1f'
 			# skip $0 to $31 and non-register numeric arguments
-			if re.match('\$0*([0-9]|[12][0-9]|3[01])$', a) or re.match('(?!\$)\d+', a):
+			if re.match('\$0*([0-9]|[12][0-9]|3[01])$', a) or (not local and re.match('(?!\$)\d+', a)):
 				continue
-			if re.match('(?!\$)-?\d+', a): # immediate value
+			if re.match('\$f0*([0-9]|[12][0-9]|3[01])$', a): # floating point register
+				continue
+			if not local and re.match('(?!\$)-?\d+', a): # immediate value
 				continue
 			if re.match('D', a):
 				args[i] = str(data_start_addr)
 			elif re.match('(?!\$)\w+', a): # if alphanumeric string, treat as label
-				if a in text_labels:
-					li = text_labels.index(a)
+				if local:
+					li = local_label(local.group(1), local.group(2), linenum)
+					t = True
+				elif a in text_symbols:
+					li = text_symbols[a]
 					t = True
-				elif a in data_labels:
-					li = data_labels.index(a)
+				elif a in data_symbols:
+					li = data_symbols[a]
 					t = False
 				else:
 					raise ASMError('Label %r not found' % a)
@@ -312,13 +1635,11 @@ def find_cmd(asm, isa):
 	returns:
 		key-value tuple from ISA matching the ASM command
 	'''
-	cmd = parse_cmd_fmt(asm)
-	for k,v in isa.items():
-		isa_cmd = parse_cmd_fmt(k)
-		if listeq(isa_cmd, cmd):
-			print('find_cmd(): %s -> %s' % (k,v))  if debug else None
-			return (k,v)
-	return (None, None)
+	k = isa.index.get(tuple(parse_cmd_fmt(asm)))
+	if k is None:
+		return (None, None)
+	print('find_cmd(): %s -> %s' % (k,isa[k]))  if debug else None
+	return (k, isa[k])
 
 def get_encoding(asm, linenum, isa):
 	global debug
@@ -330,61 +1651,148 @@ def get_encoding(asm, linenum, isa):
 	returns:
 		string representing the binary encoding of the ASM line
 	'''
-	isa_key, binstr = find_cmd(asm, isa)
-	if isa_key:
-		#if re.match('[01]+', isa_value): # single, non-pseudo instruction
-		isa_cmd = parse_cmd(isa_key)
-		asm_cmd = translate_cmd(asm, linenum)
-		print(asm_cmd)  if debug else None
-	else:
+	# once labels are resolved to numbers (branches to their offsets) the
+	# command no longer depends on its position and can be memoized
+	asm_cmd = translate_cmd(asm, linenum)
+	key = tuple(asm_cmd)
+	if key in encoding_memo:
+		encoding_memo.move_to_end(key)
+		memo_stats['hits'] += 1
+		return encoding_memo[key]
+	memo_stats['misses'] += 1
+	isa_key, isa_val = find_cmd(asm, isa)
+	if isa_key not in isa.specs: # unknown, or a pseudo-instruction
 		raise ASMError('Command not found: ' + asm)
-	for asm_arg, isa_arg in zip(asm_cmd[1:], isa_cmd[1:]):
-		binstr = put_arg(re.sub('\$', '', asm_arg),
-						re.sub('\$', '', isa_arg),
-						binstr)
-	return re.sub('-', '0', binstr) # replace don't cares ('-') with zeros
+	print(asm_cmd)  if debug else None
+	binstr = '{:032b}'.format(encode_cmd(asm_cmd, isa.specs[isa_key]))
+	if memo_size:
+		encoding_memo[key] = binstr
+		if len(encoding_memo) > memo_size:
+			encoding_memo.popitem(last=False) # evict least recently used
+	return binstr
 
-#def pseudo2real(asm, isa_value):
-	
-	
-def put_arg(val, sym, binstr):
-	global debug
-	#print('val=%r\tsym=%r\tbinstr=%r' % (val,sym,binstr))
-	n = binstr.count(sym)	# get the length of the binary number
-	if not n:
-		raise ASMError('DEV: put_arg(): sym %r not found' % sym)
-	b = int2twoscomp(int(val), n)
-	print('%s\t%s\t%s' % (val, sym, b))  if debug else None
-	out = re.sub(sym + '+', b, binstr)
-	#print(out)
-	return out
-
-def int2twoscomp(val, nbits):
-	global debug
-	b = bin(abs(val))[2:]
-	b = str('%'+str(nbits)+'s') % b
-	b = re.sub('\s', '0', b)
-	#print(b)  if debug else None
-	if val < 0:
-		b = twoscomp(b)
-	return b
-
-def onescomp(binstr):
-    return ''.join('1' if b=='0' else '0' for b in binstr)
-
-def twoscomp(binstr):
-    return bin(int(onescomp(binstr),2)+1)[2:]
-
-def get_mips_isa():
-	with open('mips_isa.txt', 'r') as f:
-		isa = {}
+def encode_cmd(asm_cmd, spec):
+	'''
+	packs the operands of a command into its instruction word
+	args:
+		asm_cmd = translated command, e.g. ['addi', '$8', '$8', '4']
+		spec = IsaSpec of the matching real command
+	returns:
+		the encoded instruction word as an int
+	'''
+	word = spec.opcode
+	args = asm_cmd[1:]
+	for i, kind, runs in spec.fields:
+		val = operand_value(args[i], kind)
+		if kind == 'size': # bit field size stored as size - 1
+			val -= 1
+		elif kind == 'msb': # bit field size stored as pos + size - 1
+			val += operand_value(args[i-1], 'imm') - 1
+		for shift, width in runs:
+			if not -(1 << (width-1)) <= val < (1 << width):
+				raise ASMError('Operand %r of %r does not fit in %d bits'
+							% (args[i], ' '.join(asm_cmd), width))
+			word |= (val & ((1 << width) - 1)) << shift
+		print('%s\t%s\t%d' % (args[i], kind, val))  if debug else None
+	return word
+
+def operand_value(arg, kind):
+	'''returns the number encoded for a translated operand of the given kind'''
+	if kind == 'gpr':
+		m = re.match('\$(\d+)$', arg)
+	elif kind == 'fpr':
+		m = re.match('\$f(\d+)$', arg)
+	else:
+		m = re.match('(-?\d+)$', arg)
+	if not m:
+		raise ASMError('Invalid %s operand %r' % (kind, arg))
+	return int(m.group(1))
+
+def compile_spec(key, binstr, fields):
+	'''
+	compiles the encoding pattern of a real command for table-driven encoding
+	args:
+		key = command syntax, e.g. 'lw $t i($s)'
+		binstr = 32 character pattern of 0, 1, - (don't care) and field letters
+		fields = operand syntax -> (encoding letter, kind) dict
+	returns:
+		IsaSpec holding the fixed bits, the mask of fixed bits and
+		(operand index, kind, ((shift, width), ...)) for each operand
+	'''
+	if len(binstr) != 32:
+		raise ASMError('Encoding of %r is not 32 bits: %r' % (key, binstr))
+	cmd = parse_cmd(key)
+	ops = []
+	letters = set()
+	for i, op in enumerate(cmd[1:]):
+		if op not in fields:
+			raise ASMError('Unknown operand %r in %r' % (op, key))
+		letter, kind = fields[op]
+		runs = tuple((32 - m.end(), m.end() - m.start())
+					for m in re.finditer(letter + '+', binstr))
+		if not runs:
+			raise ASMError('Operand %r of %r has no encoding bits' % (op, key))
+		letters.add(letter)
+		ops.append((i, kind, runs))
+	if set(binstr) - set('01-') - letters:
+		raise ASMError('Unassigned encoding bits in %r: %r' % (key, binstr))
+	opcode = int(re.sub('[^1]', '0', binstr), 2)
+	mask = int(''.join('1' if b in '01' else '0' for b in binstr), 2)
+	return IsaSpec(cmd[0], opcode, mask, tuple(ops))
+
+def get_mips_isa(filename='mips_isa.txt'):
+	'''
+	reads an ISA description, where each line is either
+		SYNTAX=ENCODING       a real command, e.g. 'add $d $s $t=000000sssss...'
+		SYNTAX=CMD;CMD...     a pseudo-instruction and its expansion
+		%field OP LETTER KIND an operand written OP in syntax and encoded in the
+		                      LETTER bits; KIND is one of field_kinds
+		%fmt NAME=BITS...     values of the 'fmt' kind field, chosen by writing
+		                      the command name as e.g. 'add.{s,d}'
+		%latency CMD=CYCLES   result latency used by the schedulers
+	args:
+		filename = ISA file, looked up next to mipster.py if not found
+	returns:
+		ISA dict
+	'''
+	if not os.path.exists(filename):
+		filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+	isa = ISA()
+	fmts = {}
+	with open(filename, 'r') as f:
 		for line in f:
 			if re.match('\s*[#\n\r]', line): # skip comments and blank lines
 				continue
+			m = re.match('%latency\s+(\S+)\s*=\s*(\d+)', line)
+			if m:
+				isa.latencies[m.group(1)] = int(m.group(2))
+				continue
+			m = re.match('%field\s+(\S+)\s+(\w)\s+(\w+)\s*$', line)
+			if m:
+				if m.group(3) not in field_kinds:
+					raise ASMError('Unknown field kind %r in %s' % (m.group(3), filename))
+				isa.fields[m.group(1)] = (m.group(2), m.group(3))
+				continue
+			m = re.match('%fmt\s+(.*)', line)
+			if m:
+				fmts.update(x.split('=') for x in m.group(1).split())
+				continue
 			k, v = line.strip().split('=')
-			isa[k.strip()] = v.strip()
+			k, v = k.strip(), v.strip()
+			# expand 'add.{s,d}' style names into one command per format
+			m = re.match('(\S*)\{(.*?)\}(.*)', k)
+			for fmt in m.group(2).split(',') if m else [None]:
+				key, val = k, v
+				if fmt is not None:
+					key = m.group(1) + fmt + m.group(3)
+					letter = [l for l, kind in isa.fields.values() if kind == 'fmt']
+					if letter and fmt in fmts:
+						val = re.sub(letter[0] + '+', fmts[fmt], val)
+				isa[key] = val
+				isa.index.setdefault(tuple(parse_cmd_fmt(key)), key)
+				if not re.match('[^01]', val): # real command
+					isa.specs[key] = compile_spec(key, val, isa.fields)
 	return isa
 
-
 if __name__ == '__main__':
-	main()
+	sys.exit(main())
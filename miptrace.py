@@ -0,0 +1,109 @@
+#! /usr/bin/python3
+'''
+Prints and filters execution traces recorded by mipsim -t
+'''
+
+import argparse
+import sys
+
+import mipster
+import mipsim
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('trace', help='trace file from mipsim -t')
+	parser.add_argument('--isa', metavar='FILE', default='mips_isa.txt',
+						help='ISA description file (default: %(default)s)')
+	parser.add_argument('-g', '--debug-info', metavar='DBG',
+						help='debug info written by mipster -g, for labels and lines')
+	parser.add_argument('-a', '--address', metavar='LO:HI', type=mipsim.range_arg,
+						help='only commands in this address range')
+	parser.add_argument('-L', '--label', metavar='NAME', action='append',
+						help='only commands under this label (needs -g)')
+	parser.add_argument('-r', '--reg', metavar='REG',
+						help='only commands writing this register (e.g. $t0, $f2, hi)')
+	parser.add_argument('-m', '--mem', metavar='LO:HI', type=mipsim.range_arg,
+						help='only loads and stores in this address range')
+	parser.add_argument('-n', '--last', metavar='N', type=int, default=0,
+						help='only the last N matching commands')
+	args = parser.parse_args()
+
+	try:
+		isa = mipster.get_mips_isa(args.isa)
+		text_start, words = mipsim.read_trace(args.trace)
+		dest = reg_arg(args.reg) if args.reg else None
+	except (mipster.ASMError, mipsim.SimError, IOError) as ex:
+		print(ex)
+		return 1
+	debug = mipster.DebugInfo(args.debug_info) if args.debug_info else None
+	if args.label and not debug:
+		print('--label needs debug info (-g)')
+		return 1
+	ranges = []
+	if args.address:
+		ranges.append(args.address)
+	for name in args.label or []:
+		ranges.append(label_range(debug, name))
+	decoder = mipsim.make_decoder(isa)
+
+	matches = []
+	for k in range(0, len(words), mipsim.trace_fields):
+		pc, word, d, value, addr = words[k:k + mipsim.trace_fields]
+		if ranges and not any(lo <= pc <= hi for lo, hi in ranges):
+			continue
+		if dest is not None and d != dest:
+			continue
+		if args.mem and not (addr != mipsim.no_value and
+							args.mem[0] <= addr <= args.mem[1]):
+			continue
+		matches.append(k)
+	if args.last:
+		matches = matches[-args.last:]
+	out = []
+	for k in matches:
+		pc, word, d, value, addr = words[k:k + mipsim.trace_fields]
+		text = mipsim.disassemble(isa, decoder, word, pc)
+		effect = ''
+		if d != mipsim.no_value:
+			effect = '%s = 0x%08x' % (reg_name(d), value)
+		if addr != mipsim.no_value:
+			effect += ' [0x%08x]' % addr
+		source = ''
+		if debug:
+			source = mipsim.symbol_name(pc, debug)
+			line = debug.line(pc)
+			if line:
+				source += ' (%s:%d)' % line
+		out.append(('%9d  %08x  %08x  %-30s %-28s %s' % (k // mipsim.trace_fields,
+			pc, word, text, effect.strip(), source)).rstrip())
+	sys.stdout.write(''.join(x + '\n' for x in out))
+	if debug:
+		debug.close()
+	return 0
+
+def reg_arg(reg):
+	'''returns the trace destination number of a register name'''
+	if reg in ('hi', 'lo'):
+		return mipsim.hi_reg if reg == 'hi' else mipsim.lo_reg
+	if reg.startswith('$f') and reg[2:].isdigit() and int(reg[2:]) < 32:
+		return 32 + int(reg[2:])
+	return mipster.reg_num(reg)
+
+def reg_name(d):
+	'''returns the name of a trace destination number'''
+	if d < 32:
+		return mipster.regs[d]
+	if d < 64:
+		return '$f%d' % (d - 32)
+	return 'hi' if d == mipsim.hi_reg else 'lo'
+
+def label_range(debug, name):
+	'''returns the addresses from a label up to the next label'''
+	addr = debug.address(name)
+	if addr is None:
+		raise SystemExit('Unknown label %r' % name)
+	later = [a for a in debug.sym_addrs if a > addr]
+	return (addr, (min(later) if later else debug.text_end) - 4)
+
+if __name__ == '__main__':
+	sys.exit(main())